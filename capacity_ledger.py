@@ -0,0 +1,388 @@
+import os
+import shutil
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import metrics
+from disk_inventory import get_inventory, disk_identity, find_by_identity
+from lsdisk_utils import backing_mounts
+from logger import get_logger
+from constance.config import (
+    IMAGE_NAME,
+    LEDGER_RECONCILE_INTERVAL,
+    PROBE_WORKERS,
+    PROBE_TIMEOUT,
+    PROBE_BACKOFF,
+)
+
+logger = get_logger(__name__)
+
+MIN_SIZE = 16 * 1024 * 1024  # 16MiB
+
+# volume_context key recording the disk CreateVolume placed the image on;
+# the image is always {volume}/{IMAGE_NAME} on it
+DISK_ID_KEY = "lsdisk.driver/disk-id"
+
+_probe_pool = ThreadPoolExecutor(
+    max_workers=PROBE_WORKERS, thread_name_prefix="disk-probe"
+)
+
+
+def _image_usage(image):
+    st = os.stat(image)
+    return st.st_size, st.st_blocks * 512
+
+
+def _set_volume(entry, volume, usage):
+    """Replace the usage of volume in a disk entry; None removes it."""
+    old_size, old_blocks = entry["volumes"].pop(volume, (0, 0))
+    entry["committed"] -= old_size
+    entry["allocated"] -= old_blocks
+    if usage is not None:
+        entry["volumes"][volume] = usage
+        entry["committed"] += usage[0]
+        entry["allocated"] += usage[1]
+
+
+def _set_fs_usage(entry, fs_usage):
+    entry["total"] = fs_usage.total
+    entry["used"] = fs_usage.used
+    entry["free"] = fs_usage.free
+
+
+class CapacityLedger:
+    """In-memory capacity accounting for every backing disk.
+
+    For each disk the ledger keeps the filesystem total/used/free bytes,
+    the volumes placed on it with their (sparse) image size and allocated
+    bytes, and the totals committed to and occupied by those images. The
+    space a disk can still hand out is its free space minus what the
+    sparse images may still grow into and minus the space reserved by
+    volumes that are being created.
+
+    Disks are loaded on first use, updated incrementally by the volume
+    RPCs and periodically reconciled with statvfs while mounted. Loading
+    and reconciling probe the disks in parallel; a disk whose probe does
+    not finish within PROBE_TIMEOUT is skipped for PROBE_BACKOFF seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._disks = {}
+        self._volume_disk = {}
+        self._timed_out = {}
+        self._probes = {}
+        self._scanning = {}
+        self._reservations = {}
+        self._reserved = {}
+        self._reservation_ids = itertools.count(1)
+        self._reconciler = None
+
+    def _scan(self, disk):
+        path = backing_mounts.mount(disk)
+        usage = shutil.disk_usage(path)
+        volumes = {}
+        for entry in os.scandir(path):
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            image = f"{entry.path}/{IMAGE_NAME}"
+            if os.path.isfile(image):
+                volumes[entry.name] = _image_usage(image)
+        return {
+            "total": usage.total,
+            "used": usage.used,
+            "free": usage.free,
+            "committed": sum(size for size, _ in volumes.values()),
+            "allocated": sum(blocks for _, blocks in volumes.values()),
+            "volumes": volumes,
+        }
+
+    def load(self, disk):
+        with self._lock:
+            self._scanning[disk] = {"volumes": {}, "fs_usage": None}
+        try:
+            entry = self._scan(disk)
+        except Exception:
+            with self._lock:
+                self._scanning.pop(disk, None)
+            raise
+        with self._lock:
+            # volumes created, resized or deleted while the disk was scanned
+            changes = self._scanning.pop(disk, {"volumes": {}, "fs_usage": None})
+            for volume, usage in changes["volumes"].items():
+                _set_volume(entry, volume, usage)
+            if changes["fs_usage"] is not None:
+                _set_fs_usage(entry, changes["fs_usage"])
+            old = self._disks.get(disk)
+            for name in old["volumes"] if old else ():
+                self._volume_disk.pop(name, None)
+            self._disks[disk] = entry
+            for name in entry["volumes"]:
+                self._volume_disk[name] = disk
+        return entry
+
+    def probe(self, disks):
+        """Load disks concurrently, bounded by the probe pool and PROBE_TIMEOUT.
+
+        A probe that is still running, such as one stuck on a hung disk,
+        is waited for again instead of taking another probe worker.
+        """
+        futures = {}
+        with self._lock:
+            for disk in disks:
+                future = self._probes.get(disk)
+                if future is None or future.done():
+                    future = _probe_pool.submit(self.load, disk)
+                    self._probes[disk] = future
+                futures[disk] = future
+        _, pending = wait(futures.values(), timeout=PROBE_TIMEOUT)
+        for disk, future in futures.items():
+            if future in pending:
+                # probes still queued behind busy workers are simply retried later
+                if future.cancel():
+                    continue
+                logger.warning(
+                    f"Probing /dev/{disk} did not finish in {PROBE_TIMEOUT}s, skipping it for {PROBE_BACKOFF}s"
+                )
+                with self._lock:
+                    self._timed_out[disk] = time.monotonic() + PROBE_BACKOFF
+                metrics.inc("disk_probe_timeouts_total")
+                continue
+            with self._lock:
+                self._timed_out.pop(disk, None)
+            e = future.exception()
+            if isinstance(e, FileNotFoundError):
+                logger.warning(f"Device /dev/{disk} not found or inaccessible.")
+            elif e is not None:
+                logger.error(f"Error loading capacity of device /dev/{disk}: {e}")
+
+    def timed_out_disks(self):
+        now = time.monotonic()
+        with self._lock:
+            return [disk for disk, until in self._timed_out.items() if until > now]
+
+    def usable(self, disks):
+        timed_out = self.timed_out_disks()
+        return [disk for disk in disks if disk not in timed_out]
+
+    def ensure(self, disks):
+        """Load the disks the ledger does not know yet."""
+        unknown = [disk for disk in self.usable(disks) if disk not in self._disks]
+        if unknown:
+            self.probe(unknown)
+
+    def available(self, disk):
+        entry = self._disks.get(disk)
+        if entry is None:
+            return 0
+        outstanding = max(0, entry["committed"] - entry["allocated"])
+        return max(0, entry["free"] - outstanding - self._reserved.get(disk, 0))
+
+    def reserved(self, disk):
+        return self._reserved.get(disk, 0)
+
+    def reserve(self, disk, size):
+        """Hold size bytes of disk for a volume that is being created."""
+        with self._lock:
+            reservation = next(self._reservation_ids)
+            self._reservations[reservation] = (disk, size)
+            self._reserved[disk] = self._reserved.get(disk, 0) + size
+        return reservation
+
+    def _release(self, reservation):
+        disk, size = self._reservations.pop(reservation, (None, 0))
+        if disk is not None:
+            self._reserved[disk] -= size
+        return disk
+
+    def release(self, reservation):
+        with self._lock:
+            return self._release(reservation)
+
+    def commit(self, reservation, volume):
+        """Turn a reservation into the accounted usage of the created volume.
+
+        The reservation is dropped in the same critical section that
+        accounts the volume, so the space never looks free in between.
+        """
+        with self._lock:
+            disk, _ = self._reservations.get(reservation, (None, 0))
+        if disk is None:
+            return
+        if disk not in self._disks:
+            self.release(reservation)
+            self.ensure([disk])
+            return
+        usage, fs_usage = self._measure(disk, volume)
+        with self._lock:
+            self._release(reservation)
+            self._apply(disk, volume, usage, fs_usage)
+
+    def get(self, disk):
+        with self._lock:
+            entry = self._disks.get(disk)
+            if entry is None:
+                return None
+            return dict(entry, volumes=dict(entry["volumes"]))
+
+    def locate(self, volume):
+        return self._volume_disk.get(volume)
+
+    def _measure(self, disk, volume, present=True):
+        """(image usage or None, filesystem usage), read outside the lock."""
+        path = backing_mounts.path_of(disk)
+        usage = _image_usage(f"{path}/{volume}/{IMAGE_NAME}") if present else None
+        return usage, shutil.disk_usage(path)
+
+    def _apply(self, disk, volume, usage, fs_usage):
+        """Account one volume change; the caller holds the lock."""
+        changes = self._scanning.get(disk)
+        if changes is not None:
+            changes["volumes"][volume] = usage
+            changes["fs_usage"] = fs_usage
+        entry = self._disks.get(disk)
+        if entry is None:
+            return
+        _set_volume(entry, volume, usage)
+        _set_fs_usage(entry, fs_usage)
+        if usage is None:
+            self._volume_disk.pop(volume, None)
+        else:
+            self._volume_disk[volume] = disk
+
+    def _update(self, disk, volume, present=True):
+        """Replace the accounted usage of one volume and refresh disk usage."""
+        usage, fs_usage = self._measure(disk, volume, present)
+        with self._lock:
+            self._apply(disk, volume, usage, fs_usage)
+
+    def add_volume(self, disk, volume):
+        if disk not in self._disks:
+            self.ensure([disk])
+            return
+        self._update(disk, volume)
+
+    def remove_volume(self, volume):
+        disk = self.locate(volume)
+        if disk:
+            self._update(disk, volume, present=False)
+
+    def resize_volume(self, volume):
+        disk = self.locate(volume)
+        if disk:
+            self._update(disk, volume)
+
+    def reconcile(self):
+        mounted = []
+        for disk in list(self._disks):
+            if os.path.ismount(backing_mounts.path_of(disk)):
+                mounted.append(disk)
+                continue
+            with self._lock:
+                entry = self._disks.pop(disk, None)
+                for name in entry["volumes"] if entry else ():
+                    self._volume_disk.pop(name, None)
+        self.probe(self.usable(mounted))
+
+    def start(self, interval=LEDGER_RECONCILE_INTERVAL):
+        if self._reconciler is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reconcile()
+
+        self._reconciler = threading.Thread(
+            target=loop, name="ledger-reconcile", daemon=True
+        )
+        self._reconciler.start()
+
+
+ledger = CapacityLedger()
+
+
+def get_device_with_most_free_space(devices):
+    devices = ledger.usable(devices)
+    ledger.ensure(devices)
+    device_with_most_space = None
+    max_free_space = 0
+    for device in devices:
+        free_space = ledger.available(device)
+        if free_space > max_free_space:
+            max_free_space = free_space
+            device_with_most_space = device
+    if device_with_most_space is None:
+        return ""
+    return device_with_most_space
+
+
+def get_full_free_spaces(devices, size):
+    devices = ledger.usable(devices)
+    ledger.ensure(devices)
+    device_with_min_space = None
+    min_free_space = 0
+    for device in devices:
+        entry = ledger.get(device)
+        if entry is None:
+            continue
+        logger.info(
+            f"Device: /dev/{device}, Total: {entry['total']}, Used: {entry['used']}, Free: {entry['free']}, size needed: {size}"
+        )
+        if entry["used"] >= MIN_SIZE or entry["volumes"] or ledger.reserved(device):
+            continue
+        free_space = entry["free"]
+        if free_space < size:
+            continue
+        if device_with_min_space is None or free_space < min_free_space:
+            min_free_space = free_space
+            device_with_min_space = device
+    if device_with_min_space is None:
+        logger.error("No valid devices found with free space.")
+        return ""
+    return device_with_min_space
+
+
+def get_available_capacity(devices):
+    devices = ledger.usable(devices)
+    ledger.ensure(devices)
+    return max((ledger.available(device) for device in devices), default=0)
+
+
+def placement_context(disk):
+    inventory_disk = get_inventory()["disks"].get(disk, {"name": disk})
+    return {DISK_ID_KEY: disk_identity(inventory_disk)}
+
+
+def _has_image(disk, volume):
+    return os.path.isfile(f"{backing_mounts.mount(disk)}/{volume}/{IMAGE_NAME}")
+
+
+def locate_volume(volume, volume_context=None, find_candidates=None):
+    """Find the backing disk holding the image of volume.
+
+    The disk recorded in volume_context is tried first, then the ledger.
+    Volumes created before the placement was recorded fall back to
+    scanning the disks returned by find_candidates.
+    """
+    identity = (volume_context or {}).get(DISK_ID_KEY)
+    if identity:
+        disk = find_by_identity(get_inventory(), identity)
+        if disk and _has_image(disk, volume):
+            return disk
+        logger.warning(f"Disk {identity} of volume {volume} not found, scanning disks")
+    disk = ledger.locate(volume)
+    if disk and _has_image(disk, volume):
+        return disk
+    if find_candidates is None:
+        return None
+    disks = find_candidates()
+    ledger.ensure(disks)
+    disk = ledger.locate(volume)
+    if disk and _has_image(disk, volume):
+        return disk
+    for disk in ledger.usable(disks):
+        if _has_image(disk, volume):
+            return disk
+    return None
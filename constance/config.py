@@ -3,4 +3,31 @@ from os import getenv
 IMAGE_NAME = getenv("IMAGE_NAME")
 MOUNT_DEST = getenv("MOUNT_DEST")
 POD_IMAGE = getenv("POD_IMAGE")
-NAMESPACE = getenv("NAMESPACE")
\ No newline at end of file
+NAMESPACE = getenv("NAMESPACE")
+DISK_DISCOVERY_BACKEND = getenv("DISK_DISCOVERY_BACKEND", "sysfs")
+INVENTORY_CACHE_TTL = float(getenv("INVENTORY_CACHE_TTL", "300"))
+LEDGER_RECONCILE_INTERVAL = float(getenv("LEDGER_RECONCILE_INTERVAL", "60"))
+PROBE_WORKERS = int(getenv("PROBE_WORKERS", "8"))
+PROBE_TIMEOUT = float(getenv("PROBE_TIMEOUT", "10"))
+PROBE_BACKOFF = float(getenv("PROBE_BACKOFF", "300"))
+LOAD_SAMPLE_INTERVAL = float(getenv("LOAD_SAMPLE_INTERVAL", "0.2"))
+GRPC_MAX_WORKERS = int(getenv("GRPC_MAX_WORKERS", "10"))
+INFORMER_RESYNC = float(getenv("INFORMER_RESYNC", "300"))
+INFORMER_RETRY_DELAY = float(getenv("INFORMER_RETRY_DELAY", "5"))
+KUBE_CONNECTION_POOL_SIZE = int(getenv("KUBE_CONNECTION_POOL_SIZE", "16"))
+KUBE_REQUEST_TIMEOUT = float(getenv("KUBE_REQUEST_TIMEOUT", "30"))
+# node: grow images in NodeExpandVolume; pod: run extend_image.py in a helper pod
+EXPANSION_MODE = getenv("EXPANSION_MODE", "node")
+COMMAND_TIMEOUT = float(getenv("COMMAND_TIMEOUT", "600"))
+METRICS_PORT = int(getenv("METRICS_PORT", "9810"))
+# comma separated storage models to keep pre-formatted images for; empty disables the pool
+IMAGE_POOL_MODELS = [m for m in getenv("IMAGE_POOL_MODELS", "").split(",") if m]
+IMAGE_POOL_SIZE = int(getenv("IMAGE_POOL_SIZE", "2"))
+IMAGE_POOL_BUCKETS = getenv("IMAGE_POOL_BUCKETS", "1Gi,10Gi")
+IMAGE_POOL_REFILL_INTERVAL = float(getenv("IMAGE_POOL_REFILL_INTERVAL", "30"))
+IMAGE_POOL_MAX_UTILISATION = float(getenv("IMAGE_POOL_MAX_UTILISATION", "0.3"))
+# bytes per second for each full image copy (clones across disks), 0 for no limit
+CLONE_RATE_LIMIT = int(getenv("CLONE_RATE_LIMIT", "0"))
+CLONE_MAX_CONCURRENT = int(getenv("CLONE_MAX_CONCURRENT", "2"))
+# seconds a volume may stay frozen while a snapshot or clone is copied from it
+SNAPSHOT_FREEZE_TIMEOUT = float(getenv("SNAPSHOT_FREEZE_TIMEOUT", "60"))
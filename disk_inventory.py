@@ -0,0 +1,331 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from pathlib import Path
+import metrics
+from utils import run_out
+from logger import get_logger
+from constance.config import DISK_DISCOVERY_BACKEND, INVENTORY_CACHE_TTL
+
+logger = get_logger(__name__)
+
+HDD = "HDD"
+SSD = "SSD"
+SYS_BLOCK = Path("/sys/block")
+
+# LVM2 writes its label into one of the first four 512-byte sectors
+LVM_LABEL_SECTORS = 4
+LVM_LABEL_ID = b"LABELONE"
+LVM_LABEL_TYPE = b"LVM2 001"
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+INOTIFY_WATCH_DIR = b"/dev"
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def disk_type_of(rotational):
+    return HDD if rotational else SSD
+
+
+def _as_bool(value):
+    # lsblk reports ROTA as a JSON bool on recent util-linux and as "0"/"1" on older ones
+    if isinstance(value, str):
+        return value.strip() not in ("", "0", "false")
+    return bool(value)
+
+
+def _as_str(value):
+    return (value or "").strip()
+
+
+def _list_lvm_pvs():
+    res = run_out(["pvs", "--noheadings", "-o", "pv_name"])
+    if res.returncode != 0:
+        return set()
+    return {line.strip() for line in res.stdout.decode().splitlines() if line.strip()}
+
+
+def _scan_lsblk():
+    res = run_out(["lsblk", "--json", "-o", "NAME,MODEL,SERIAL,WWN,ROTA,TYPE"])
+    if res.returncode != 0:
+        logger.error(f"lsblk failed: {res.stderr.decode().strip()}")
+        return []
+    data = json.loads(res.stdout.decode())
+    pvs = _list_lvm_pvs()
+    disks = []
+    for dev in data.get("blockdevices", []):
+        # roms, loop devices (our own volumes among them) and the like
+        if dev.get("type") != "disk":
+            continue
+        name = dev["name"]
+        disks.append(
+            {
+                "name": name,
+                "model": _as_str(dev.get("model")),
+                "serial": _as_str(dev.get("serial")),
+                "wwn": _as_str(dev.get("wwn")),
+                "rotational": _as_bool(dev.get("rota")),
+                "children": [child["name"] for child in dev.get("children") or []],
+                "lvm_pv": f"/dev/{name}" in pvs,
+            }
+        )
+    return disks
+
+
+def _read_sysfs(path):
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return ""
+
+
+def _sysfs_serial(dev_dir):
+    for candidate in (dev_dir / "device" / "serial", dev_dir / "serial"):
+        serial = _read_sysfs(candidate)
+        if serial:
+            return serial
+    # SCSI disks only expose the serial number through the unit serial VPD page
+    try:
+        page = (dev_dir / "device" / "vpd_pg80").read_bytes()
+    except OSError:
+        return ""
+    return page[4:].decode(errors="ignore").strip("\x00 \n")
+
+
+def _sysfs_wwn(dev_dir):
+    for candidate in (dev_dir / "wwid", dev_dir / "device" / "wwid"):
+        wwid = _read_sysfs(candidate)
+        if wwid:
+            # match the 0x-prefixed form lsblk reports for NAA identifiers
+            if wwid.startswith("naa."):
+                return "0x" + wwid[len("naa."):]
+            return wwid
+    return ""
+
+
+def _sysfs_children(dev_dir):
+    children = [
+        entry.name for entry in dev_dir.iterdir() if (entry / "partition").exists()
+    ]
+    try:
+        children.extend(os.listdir(dev_dir / "holders"))
+    except OSError:
+        pass
+    return children
+
+
+def _has_lvm_label(name):
+    try:
+        with open(f"/dev/{name}", "rb") as dev:
+            head = dev.read(LVM_LABEL_SECTORS * 512)
+    except OSError:
+        return False
+    for sector in range(LVM_LABEL_SECTORS):
+        offset = sector * 512
+        if (
+            head[offset : offset + 8] == LVM_LABEL_ID
+            and head[offset + 24 : offset + 32] == LVM_LABEL_TYPE
+        ):
+            return True
+    return False
+
+
+def _scan_sysfs():
+    disks = []
+    for dev_dir in sorted(SYS_BLOCK.iterdir()):
+        name = dev_dir.name
+        model = _read_sysfs(dev_dir / "device" / "model")
+        children = _sysfs_children(dev_dir)
+        disks.append(
+            {
+                "name": name,
+                "model": model,
+                "serial": _sysfs_serial(dev_dir),
+                "wwn": _sysfs_wwn(dev_dir),
+                "rotational": _read_sysfs(dev_dir / "queue" / "rotational") == "1",
+                "children": children,
+                # a PV without active LVs has no holders, so look for its label;
+                # disks that can never be picked are not worth opening
+                "lvm_pv": bool(model) and not children and _has_lvm_label(name),
+            }
+        )
+    return disks
+
+
+BACKENDS = {
+    "sysfs": _scan_sysfs,
+    "lsblk": _scan_lsblk,
+}
+
+
+def index_disks(disks):
+    """Index scanned disks by name, by model and by (model, disk type).
+
+    Only disks that are safe to use (no partitions, holders or LVM
+    signature) are listed in the model indexes.
+    """
+    inventory = {"disks": {}, "by_model": {}, "by_model_type": {}}
+    for disk in disks:
+        disk["type"] = disk_type_of(disk["rotational"])
+        disk["safe"] = not disk["children"] and not disk["lvm_pv"]
+        inventory["disks"][disk["name"]] = disk
+        if not disk["model"] or not disk["safe"]:
+            continue
+        inventory["by_model"].setdefault(disk["model"], []).append(disk["name"])
+        inventory["by_model_type"].setdefault(
+            (disk["model"], disk["type"]), []
+        ).append(disk["name"])
+    return inventory
+
+
+def build_inventory(backend=None):
+    """Scan all block devices with the selected discovery backend.
+
+    The sysfs backend reads /sys/block without spawning any process; the
+    lsblk backend needs one lsblk call plus one PV listing and is used
+    when sysfs is not available.
+    """
+    backend = backend or DISK_DISCOVERY_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown disk discovery backend: {backend}")
+    if backend == "sysfs" and not SYS_BLOCK.is_dir():
+        logger.warning(f"{SYS_BLOCK} is not available, falling back to lsblk")
+        backend = "lsblk"
+    return index_disks(BACKENDS[backend]())
+
+
+def disk_identity(disk):
+    """Stable identity of a disk that survives sdX renames: WWN, else serial."""
+    if disk.get("wwn"):
+        return f"wwn:{disk['wwn']}"
+    if disk.get("serial"):
+        return f"serial:{disk['serial']}"
+    return f"name:{disk['name']}"
+
+
+def find_by_identity(inventory, identity):
+    """Name of the disk with the given identity, or None."""
+    kind, _, value = identity.partition(":")
+    for disk in inventory["disks"].values():
+        if kind in ("wwn", "serial") and disk.get(kind) == value:
+            return disk["name"]
+        if kind == "name" and disk["name"] == value:
+            return disk["name"]
+    return None
+
+
+class InventoryCache:
+    """Process-wide disk inventory kept current by block device events.
+
+    The inventory is built once and then served from memory. Kernel
+    uevents for block devices (or, when the uevent socket is not
+    available, inotify on /dev) mark it stale so the next reader rebuilds
+    it; the TTL bounds how long a missed event can go unnoticed.
+    """
+
+    def __init__(self, ttl=INVENTORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._inventory = None
+        self._built_at = 0.0
+        self._stale = True
+        self._watcher = None
+
+    def get(self):
+        with self._lock:
+            expired = time.monotonic() - self._built_at > self.ttl
+            if self._inventory is None or self._stale or expired:
+                # clear the flag first so an event racing with the scan is kept
+                self._stale = False
+                self._inventory = build_inventory()
+                self._built_at = time.monotonic()
+                metrics.inc("inventory_cache_rebuilds_total")
+            else:
+                metrics.inc("inventory_cache_hits_total")
+            return self._inventory
+
+    def invalidate(self, reason=""):
+        logger.debug(f"Disk inventory invalidated: {reason}")
+        self._stale = True
+
+    def start(self):
+        self.get()
+        if self._watcher is not None:
+            return
+        self._watcher = threading.Thread(
+            target=self._watch, name="inventory-watch", daemon=True
+        )
+        self._watcher.start()
+
+    def _watch(self):
+        try:
+            self._watch_uevents()
+        except OSError as e:
+            logger.warning(f"Cannot listen to kernel uevents ({e}), using inotify on /dev")
+        try:
+            self._watch_dev()
+        except OSError as e:
+            logger.warning(
+                f"Cannot watch /dev ({e}), disk inventory relies on the {self.ttl}s TTL"
+            )
+
+    def _watch_uevents(self):
+        sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+        )
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+        logger.info("Watching kernel uevents for block device changes")
+        while True:
+            event = parse_uevent(sock.recv(16384))
+            if event.get("SUBSYSTEM") != "block":
+                continue
+            # loop devices come and go with every staged volume and never
+            # change which backing disks are usable
+            if event.get("DEVNAME", "").startswith("loop"):
+                continue
+            self.invalidate(f"{event.get('ACTION')} {event.get('DEVNAME')}")
+
+    def _watch_dev(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(fd, INOTIFY_WATCH_DIR, IN_CREATE | IN_DELETE) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        logger.info("Watching /dev for block device changes")
+        while True:
+            data = os.read(fd, 16384)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\x00").decode()
+                offset += length
+                if not name.startswith("loop"):
+                    self.invalidate(f"/dev/{name} changed")
+
+
+def parse_uevent(message):
+    """Parse a kernel uevent ("action@devpath\0KEY=VALUE\0...") into a dict."""
+    event = {}
+    for field in message.split(b"\x00")[1:]:
+        key, sep, value = field.partition(b"=")
+        if sep:
+            event[key.decode()] = value.decode(errors="ignore")
+    return event
+
+
+inventory_cache = InventoryCache()
+
+
+def get_inventory():
+    return inventory_cache.get()
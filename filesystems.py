@@ -0,0 +1,180 @@
+import shlex
+import mounts
+
+EXT4 = "ext4"
+XFS = "xfs"
+FS_TYPES = (EXT4, XFS)
+DEFAULT_FS = EXT4
+
+# volume_context keys carrying the filesystem choices of the StorageClass
+FS_TYPE_KEY = "lsdisk.driver/fs-type"
+MOUNT_OPTIONS_KEY = "lsdisk.driver/mount-options"
+# set on volumes whose filesystem is grown to the image size on the first
+# staging; the marker file next to the image records that it was done
+GROW_FS_KEY = "lsdisk.driver/grow-fs"
+FS_GROWN_MARKER = ".fs-grown"
+
+# mkfs.xfs refuses filesystems smaller than this
+MIN_SIZE = {EXT4: 16 * 1024 * 1024, XFS: 300 * 1024 * 1024}
+
+# Defaults for images. 4 KiB blocks/sectors keep the loop block size
+# able to follow 4Kn disks; discard is off because it would punch the
+# preallocated extents back out of the image.
+MKFS_DEFAULTS = {
+    EXT4: ["-b", "4096", "-E", "lazy_itable_init=1,lazy_journal_init=1,nodiscard"],
+    XFS: ["-s", "size=4096", "-K"],
+}
+
+# mkfs options a StorageClass may pass, mapped to whether they take a
+# value; mkfs.xfs refuses a respecified -s, which the defaults set
+MKFS_OPTIONS = {
+    EXT4: {
+        "-b": True,
+        "-E": True,
+        "-i": True,
+        "-I": True,
+        "-J": True,
+        "-L": True,
+        "-m": True,
+        "-N": True,
+        "-O": True,
+        "-T": True,
+    },
+    XFS: {
+        "-b": True,
+        "-d": True,
+        "-i": True,
+        "-K": False,
+        "-l": True,
+        "-L": True,
+        "-m": True,
+        "-n": True,
+    },
+}
+
+# suboptions that would point mkfs at another file or device; any other
+# value that is an absolute path is refused too
+MKFS_FORBIDDEN = ("name", "file", "device", "protofile", "logdev", "rtdev")
+
+# options that only restate the defaults
+MOUNT_NOOPS = ("defaults", "rw", "async", "atime", "suid", "dev", "exec")
+
+# filesystem specific options passed in the mount data string; a name
+# ending in "=" takes a value
+MOUNT_DATA_OPTIONS = {
+    EXT4: (
+        "data=",
+        "commit=",
+        "stripe=",
+        "errors=",
+        "init_itable=",
+        "barrier=",
+        "nobarrier",
+        "discard",
+        "nodiscard",
+        "journal_checksum",
+        "journal_async_commit",
+        "auto_da_alloc",
+        "noauto_da_alloc",
+        "delalloc",
+        "nodelalloc",
+        "dioread_nolock",
+        "noinit_itable",
+    ),
+    XFS: (
+        "logbsize=",
+        "logbufs=",
+        "allocsize=",
+        "largeio",
+        "nolargeio",
+        "inode64",
+        "noquota",
+        "swalloc",
+        "discard",
+        "nodiscard",
+        "wsync",
+        "attr2",
+        "noattr2",
+    ),
+}
+
+
+def check_fstype(fstype):
+    if fstype not in FS_TYPES:
+        raise ValueError(f"Unsupported fsType {fstype}, expected one of {', '.join(FS_TYPES)}")
+    return fstype
+
+
+def parse_mkfs_options(fstype, options):
+    """Split a mkfsOptions string and check it against the allow-list.
+
+    Raises ValueError for options that are not allowed for fstype.
+    """
+    allowed = MKFS_OPTIONS[check_fstype(fstype)]
+    args = shlex.split(options or "")
+    i = 0
+    while i < len(args):
+        option = args[i]
+        if option not in allowed:
+            raise ValueError(f"mkfs option {option} is not allowed for {fstype}")
+        if allowed[option]:
+            if i + 1 >= len(args) or args[i + 1].startswith("-"):
+                raise ValueError(f"mkfs option {option} needs a value")
+            for sub in args[i + 1].split(","):
+                name, _, value = sub.partition("=")
+                if name in MKFS_FORBIDDEN or value.startswith("/"):
+                    raise ValueError(f"mkfs option {option} {sub} is not allowed")
+            i += 1
+        i += 1
+    return args
+
+
+def mkfs_argv(fstype, options, target):
+    """mkfs command for target: the defaults followed by options.
+
+    mke2fs only keeps the last -E, so every -E from the StorageClass is
+    merged into the default one.
+    """
+    args = list(MKFS_DEFAULTS[fstype])
+    rest = []
+    i = 0
+    while i < len(options):
+        if fstype == EXT4 and options[i] == "-E":
+            args[args.index("-E") + 1] += "," + options[i + 1]
+            i += 2
+        else:
+            rest.append(options[i])
+            i += 1
+    return [f"mkfs.{fstype}"] + args + rest + [target]
+
+
+def _split_mount_options(options):
+    for option in options:
+        for part in option.split(","):
+            part = part.strip()
+            if part:
+                yield part
+
+
+def parse_mount_options(fstype, options):
+    """Turn mount options into mount(2) flags and a data string.
+
+    options is a list of strings, each of which may hold several comma
+    separated options. Raises ValueError for options that are not
+    allowed for fstype.
+    """
+    data_options = MOUNT_DATA_OPTIONS[check_fstype(fstype)]
+    flags = 0
+    data = []
+    for option in _split_mount_options(options):
+        if option in mounts.FLAG_OPTIONS:
+            flags |= mounts.FLAG_OPTIONS[option]
+        elif option in MOUNT_NOOPS:
+            continue
+        elif option in data_options or (
+            "=" in option and option.split("=", 1)[0] + "=" in data_options
+        ):
+            data.append(option)
+        else:
+            raise ValueError(f"Mount option {option} is not allowed for {fstype}")
+    return flags, ",".join(data)
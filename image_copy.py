@@ -0,0 +1,171 @@
+import errno
+import fcntl
+import os
+import threading
+import time
+from contextlib import nullcontext
+import metrics
+from logger import get_logger
+from constance.config import (
+    CLONE_RATE_LIMIT,
+    CLONE_MAX_CONCURRENT,
+    SNAPSHOT_FREEZE_TIMEOUT,
+)
+
+logger = get_logger(__name__)
+
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning the filesystem cannot share extents between these files
+REFLINK_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL)
+
+COPY_CHUNK = 64 * 1024 * 1024
+
+# copy_file_range cannot copy between these files; use sendfile instead
+COPY_RANGE_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+
+# full copies stream every byte through the disks, so only a few run at once
+_copy_slots = threading.BoundedSemaphore(CLONE_MAX_CONCURRENT)
+
+
+class ReflinkUnsupported(Exception):
+    pass
+
+
+def reflink(src, dst):
+    """Create dst sharing all extents of src.
+
+    Takes time proportional to the extent map, not the data. Raises
+    ReflinkUnsupported if the filesystem cannot do it (ext4, or src and
+    dst on different filesystems).
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError as e:
+            os.close(dst_fd)
+            os.unlink(dst)
+            if e.errno in REFLINK_UNSUPPORTED:
+                raise ReflinkUnsupported(f"Cannot reflink {src} to {dst}: {e.strerror}")
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _data_extents(fd, size):
+    """(offset, length) of the data regions of fd, skipping holes."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole is left
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+class _Throttle:
+    """Sleeps enough to keep the bytes passed to add() under rate per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def add(self, count):
+        self.done += count
+        if self.rate:
+            ahead = self.done / self.rate - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    try:
+        return os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+    except OSError as e:
+        if e.errno not in COPY_RANGE_UNSUPPORTED:
+            raise
+    # sendfile writes at the file position of dst_fd
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, length)
+
+
+def sparse_copy(src, dst, rate=0, stop=None):
+    """Copy src to dst, keeping holes, with copy_file_range.
+
+    Only the data regions found with SEEK_DATA/SEEK_HOLE are copied and
+    the data never passes through user space; where copy_file_range
+    cannot be used (older kernels across filesystems) sendfile is.
+    rate limits the copy to that many bytes per second and setting the
+    threading.Event stop aborts it with InterruptedError. Returns the
+    number of bytes copied.
+    """
+    throttle = _Throttle(rate)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.ftruncate(dst_fd, size)
+            for offset, length in _data_extents(src_fd, size):
+                end = offset + length
+                while offset < end:
+                    if stop is not None and stop.is_set():
+                        raise InterruptedError(f"Copy of {src} to {dst} stopped")
+                    copied = _copy_range(
+                        src_fd, dst_fd, offset, min(COPY_CHUNK, end - offset)
+                    )
+                    if copied == 0:
+                        break
+                    offset += copied
+                    throttle.add(copied)
+            os.fsync(dst_fd)
+        except Exception:
+            os.unlink(dst)
+            raise
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return throttle.done
+
+
+def _not_frozen(timeout=None):
+    return nullcontext()
+
+
+def copy_image(src, dst, rate=CLONE_RATE_LIMIT, freeze=_not_frozen):
+    """Make dst a copy of src: a reflink where the filesystem allows it,
+    otherwise a sparse copy limited to rate bytes per second.
+
+    freeze(timeout) is entered around the reflink or copy; it yields an
+    event that stops the copy when set (see snapshots.frozen).
+    """
+    start = time.monotonic()
+    try:
+        with freeze():
+            reflink(src, dst)
+        method, copied = "reflink", 0
+    except ReflinkUnsupported:
+        # wait for a slot before freezing, the source is only frozen
+        # while it is copied
+        with _copy_slots:
+            with freeze(timeout=SNAPSHOT_FREEZE_TIMEOUT) as stop:
+                method, copied = "copy", sparse_copy(src, dst, rate, stop)
+    duration = time.monotonic() - start
+    metrics.observe("clone_duration_seconds", duration, method=method)
+    metrics.inc("clone_bytes_total", copied)
+    logger.info(
+        f"Copied {src} to {dst} by {method}: {copied} bytes in {duration:.3f}s"
+        f" ({copied / duration / 1024 / 1024 if duration else 0:.1f} MiB/s)"
+    )
+    return method
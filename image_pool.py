@@ -0,0 +1,179 @@
+import os
+import re
+import shutil
+import threading
+import uuid
+import metrics
+from lsdisk_utils import (
+    create_img,
+    find_disk,
+    backing_mounts,
+    mark_complete,
+    mark_incomplete,
+)
+from capacity_ledger import ledger
+from placement import disk_utilisation
+from utils import run, be_absent
+from logger import get_logger
+from constance.config import (
+    IMAGE_NAME,
+    IMAGE_POOL_MODELS,
+    IMAGE_POOL_SIZE,
+    IMAGE_POOL_BUCKETS,
+    IMAGE_POOL_REFILL_INTERVAL,
+    IMAGE_POOL_MAX_UTILISATION,
+)
+
+logger = get_logger(__name__)
+
+# pooled images live in {disk}/.pool/{bucket}-{id}; the ledger ignores
+# dot directories so they are not accounted as volumes
+POOL_DIR = ".pool"
+BUILD_PREFIX = ".build-"
+
+_UNITS = {"": 1, "Ki": 1 << 10, "Mi": 1 << 20, "Gi": 1 << 30, "Ti": 1 << 40}
+_SIZE = re.compile(r"^(\d+)(Ki|Mi|Gi|Ti)?$")
+
+
+def parse_size(size):
+    match = _SIZE.match(size.strip())
+    if not match:
+        raise ValueError(f"Invalid size {size}")
+    return int(match.group(1)) * _UNITS[match.group(2) or ""]
+
+
+def _entries(pool, bucket):
+    try:
+        names = os.listdir(pool)
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith(f"{bucket}-"))
+
+
+class ImagePool:
+    """Pre-formatted images kept ready on the disks of some storage models.
+
+    Each disk holds up to `size` images per size bucket. CreateVolume
+    claims the largest bucket not above the requested size by renaming
+    it into place and grows it if needed. A background thread refills
+    the pool, at most one image per disk per pass and only on disks
+    whose utilisation is below IMAGE_POOL_MAX_UTILISATION, so building
+    images does not compete with volume I/O.
+    """
+
+    def __init__(self, models, size, buckets):
+        self.models = models
+        self.size = size
+        self.buckets = sorted(buckets)
+        self._wakeup = threading.Event()
+        self._refiller = None
+
+    @property
+    def enabled(self):
+        return bool(self.models) and self.size > 0 and bool(self.buckets)
+
+    def _bucket_for(self, size):
+        fitting = [bucket for bucket in self.buckets if bucket <= size]
+        return fitting[-1] if fitting else None
+
+    def claim(self, path, volume, size):
+        """Move a pooled image of the disk mounted at path to volume.
+
+        Returns False if the pool has no image for size.
+        """
+        bucket = self._bucket_for(size)
+        pool = f"{path}/{POOL_DIR}"
+        for entry in _entries(pool, bucket) if bucket else ():
+            target = f"{path}/{volume}"
+            try:
+                os.rename(f"{pool}/{entry}", target)
+            except FileNotFoundError:
+                # claimed by a concurrent request
+                continue
+            except OSError as e:
+                logger.warning(f"Cannot claim pooled image for {volume}: {e}")
+                break
+            try:
+                if size > bucket:
+                    # not complete until the filesystem is grown
+                    mark_incomplete(target)
+                    img_file = f"{target}/{IMAGE_NAME}"
+                    os.truncate(img_file, size)
+                    run(["resize2fs", img_file])
+                    mark_complete(target)
+            except Exception:
+                be_absent(target)
+                raise
+            logger.info(f"Claimed pooled image {entry} for {volume}")
+            metrics.inc("image_pool_hits_total")
+            self._wakeup.set()
+            return True
+        metrics.inc("image_pool_misses_total")
+        return False
+
+    def _disks(self):
+        disks = []
+        for model in self.models:
+            disks += find_disk(model)
+        return ledger.usable(sorted(set(disks)))
+
+    def _fill_disk(self, disk):
+        with backing_mounts.use(disk) as path:
+            pool = f"{path}/{POOL_DIR}"
+            os.makedirs(pool, exist_ok=True)
+            for name in os.listdir(pool):
+                if name.startswith(BUILD_PREFIX):
+                    shutil.rmtree(f"{pool}/{name}", ignore_errors=True)
+            built = False
+            for bucket in self.buckets:
+                count = len(_entries(pool, bucket))
+                if count < self.size and not built and ledger.available(disk) >= bucket:
+                    build = f"{pool}/{BUILD_PREFIX}{uuid.uuid4().hex}"
+                    create_img(path=build, size=bucket)
+                    os.rename(build, f"{pool}/{bucket}-{uuid.uuid4().hex}")
+                    metrics.inc("image_pool_builds_total")
+                    count += 1
+                    built = True
+                metrics.set_gauge("image_pool_images", count, disk=disk, bucket=bucket)
+            return built
+
+    def refill(self):
+        """Build at most one image on every idle disk; True if any was built."""
+        disks = self._disks()
+        ledger.ensure(disks)
+        try:
+            utilisation = disk_utilisation(disks)
+        except OSError as e:
+            logger.warning(f"Cannot read disk utilisation ({e}), not refilling the image pool")
+            return False
+        built = False
+        for disk in disks:
+            if utilisation[disk] > IMAGE_POOL_MAX_UTILISATION:
+                continue
+            try:
+                built = self._fill_disk(disk) or built
+            except Exception as e:
+                logger.error(f"Refilling the image pool on /dev/{disk} failed: {e}")
+        return built
+
+    def start(self, interval=IMAGE_POOL_REFILL_INTERVAL):
+        if self._refiller is not None or not self.enabled:
+            return
+
+        def loop():
+            while True:
+                # keep going while there is something to build, otherwise
+                # sleep until a claim or the next interval
+                if not self.refill():
+                    self._wakeup.wait(interval)
+                    self._wakeup.clear()
+
+        self._refiller = threading.Thread(target=loop, name="image-pool", daemon=True)
+        self._refiller.start()
+
+
+image_pool = ImagePool(
+    IMAGE_POOL_MODELS,
+    IMAGE_POOL_SIZE,
+    [parse_size(bucket) for bucket in IMAGE_POOL_BUCKETS.split(",") if bucket],
+)
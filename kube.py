@@ -0,0 +1,380 @@
+import socket
+import threading
+import time
+
+from munch import Munch
+from kubernetes import client, config, watch
+from urllib3.connection import HTTPConnection
+import metrics
+from logger import get_logger
+from constance.config import (
+    INFORMER_RESYNC,
+    INFORMER_RETRY_DELAY,
+    KUBE_CONNECTION_POOL_SIZE,
+    KUBE_REQUEST_TIMEOUT,
+)
+
+logger = get_logger(__name__)
+
+_api_client = None
+_api_client_lock = threading.Lock()
+
+# keep-alive probes so a watch on a dead connection fails in about a
+# minute instead of hanging until its request timeout
+SOCKET_OPTIONS = [
+    *HTTPConnection.default_socket_options,
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    *(
+        (socket.IPPROTO_TCP, getattr(socket, name), value)
+        for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3))
+        if hasattr(socket, name)
+    ),
+]
+
+
+def get_api_client():
+    """The process-wide ApiClient, created on first use.
+
+    In-cluster config is only loaded here, so importing this module does
+    not need a cluster. All API objects share the client's urllib3 pool.
+    """
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            configuration = client.Configuration()
+            config.load_incluster_config(client_configuration=configuration)
+            configuration.connection_pool_maxsize = KUBE_CONNECTION_POOL_SIZE
+            _api_client = client.ApiClient(configuration)
+            # the pinned client does not pass configuration.socket_options
+            # to urllib3; the pool manager hands these to every connection
+            _api_client.rest_client.pool_manager.connection_pool_kw[
+                "socket_options"
+            ] = SOCKET_OPTIONS
+        return _api_client
+
+
+def core_v1():
+    return client.CoreV1Api(get_api_client())
+
+
+def storage_v1():
+    return client.StorageV1Api(get_api_client())
+
+
+class ResourceCache:
+    """Informer-style local cache of one cluster-scoped resource kind.
+
+    A background thread lists the resource, then watches it from the
+    listed resourceVersion and relists every `resync` seconds or when
+    the watch breaks. Only a compact projection of each object is kept.
+    Lookups that miss the cache (not synced yet, or an object the watch
+    has not delivered) fall back to a direct GET.
+    """
+
+    def __init__(self, kind, list_func, read_func, project, resync=INFORMER_RESYNC):
+        self.kind = kind
+        self.list_func = list_func
+        self.read_func = read_func
+        self.project = project
+        self.resync = resync
+        self._lock = threading.Lock()
+        self._store = {}
+        self._synced = False
+        self._thread = None
+
+    def get(self, name):
+        with self._lock:
+            item = self._store.get(name)
+        if item is not None:
+            metrics.inc(f"{self.kind}_cache_hits_total")
+            return item
+        metrics.inc(f"{self.kind}_cache_misses_total")
+        item = self.project(
+            self.read_func()(name, _request_timeout=KUBE_REQUEST_TIMEOUT)
+        )
+        with self._lock:
+            self._store[name] = item
+        return item
+
+    def items(self):
+        """All objects, listed directly if the cache has not synced yet."""
+        with self._lock:
+            synced = self._synced
+        if not synced:
+            self._list()
+        with self._lock:
+            return list(self._store.values())
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name=f"{self.kind}-informer", daemon=True
+        )
+        self._thread.start()
+
+    def _list(self):
+        result = self.list_func()(_request_timeout=KUBE_REQUEST_TIMEOUT)
+        store = {item.metadata.name: self.project(item) for item in result.items}
+        with self._lock:
+            self._store = store
+            self._synced = True
+        return result.metadata.resource_version
+
+    def _watch(self, resource_version):
+        stream = watch.Watch().stream(
+            self.list_func(),
+            resource_version=resource_version,
+            timeout_seconds=int(self.resync),
+            _request_timeout=self.resync + KUBE_REQUEST_TIMEOUT,
+        )
+        for event in stream:
+            item = event["object"]
+            name = item.metadata.name
+            with self._lock:
+                if event["type"] == "DELETED":
+                    self._store.pop(name, None)
+                else:
+                    self._store[name] = self.project(item)
+
+    def _run(self):
+        while True:
+            try:
+                self._watch(self._list())
+            except Exception as e:
+                # a 410 Gone or a broken connection both end in a fresh relist
+                logger.warning(f"{self.kind} informer restarting: {e}")
+                time.sleep(INFORMER_RETRY_DELAY)
+
+
+def _project_pv(pv):
+    pv = Munch.fromDict(pv)
+    try:
+        node_name = (
+            pv.spec.node_affinity.required.node_selector_terms[0]
+            .match_expressions[0]
+            .values[0]
+        )
+    except (AttributeError, IndexError, TypeError):
+        node_name = ""
+    return {
+        "name": pv.metadata.name,
+        "storage_class_name": pv.spec.storage_class_name,
+        "node_name": node_name,
+    }
+
+
+def _project_storage_class(storage_class):
+    storage_class = Munch.fromDict(storage_class)
+    return {
+        "name": storage_class.metadata.name,
+        "provisioner": storage_class.provisioner,
+        "parameters": dict(storage_class.parameters or {}),
+    }
+
+
+pv_cache = ResourceCache(
+    "persistentvolume",
+    list_func=lambda: core_v1().list_persistent_volume,
+    read_func=lambda: core_v1().read_persistent_volume,
+    project=_project_pv,
+)
+storage_class_cache = ResourceCache(
+    "storageclass",
+    list_func=lambda: storage_v1().list_storage_class,
+    read_func=lambda: storage_v1().read_storage_class,
+    project=_project_storage_class,
+)
+
+
+def start_informers():
+    pv_cache.start()
+    storage_class_cache.start()
+
+
+def get_node_from_pv(pvname):
+    node_name = pv_cache.get(pvname)["node_name"]
+    if node_name == "":
+        raise Exception("Node name is empty")
+    return node_name
+
+
+def get_storageclass_storagemodel_param(storageclass_name):
+    storage_class = storage_class_cache.get(storageclass_name)
+    storage_model = storage_class["parameters"]["storagemodel"]
+    return str(storage_model)
+
+def get_storageclass_disktype_param(storageclass_name):
+    storage_class = storage_class_cache.get(storageclass_name)
+    storage_model = storage_class["parameters"]["disk_type"]
+    return storage_model
+
+def get_storageclass_fulldisk_param(storageclass_name):
+    storage_class = storage_class_cache.get(storageclass_name)
+    storage_model = storage_class["parameters"]["full_disk"]
+    return storage_model
+
+def get_storageclasses(provisioner):
+    return [
+        storage_class
+        for storage_class in storage_class_cache.items()
+        if storage_class["provisioner"] == provisioner
+    ]
+
+
+def get_storageclass_from_pv(pvname):
+    return pv_cache.get(pvname)["storage_class_name"]
+
+
+def run_pod(
+    pod_name, node, image, namespace="default", command=None, args=None, env_vars=None
+):
+    v1 = core_v1()
+
+    env = []
+    if env_vars:
+        env = [client.V1EnvVar(name=k, value=str(v)) for k, v in env_vars.items()]
+
+    container = client.V1Container(
+        name=pod_name,
+        image=image,
+        command=command,
+        args=args,
+        env=env,
+        security_context=client.V1SecurityContext(
+            privileged=True
+        ),  # Add securityContext here
+    )
+
+    # Add nodeSelector to specify the node
+    pod_spec = client.V1PodSpec(
+        containers=[container],
+        restart_policy="Never",
+        node_selector={"kubernetes.io/hostname": node},  # Specify the node here
+        tolerations=[client.V1Toleration(operator="Exists")],  # tolerate all taints
+    )
+
+    metadata = client.V1ObjectMeta(name=pod_name)
+
+    pod = client.V1Pod(
+        api_version="v1",
+        kind="Pod",
+        metadata=metadata,
+        spec=pod_spec,
+    )
+
+    try:
+        response = v1.create_namespaced_pod(
+            namespace=namespace, body=pod, _request_timeout=KUBE_REQUEST_TIMEOUT
+        )
+        logger.info(f"Pod {pod_name} created in namespace {namespace}")
+        return response
+    except client.exceptions.ApiException as e:
+        # If pod already exists, return the existing pod instead of raising
+        if getattr(e, "status", None) == 409:
+            logger.info(f"Pod {pod_name} already exists in namespace {namespace}, returning existing pod")
+            try:
+                existing = v1.read_namespaced_pod(
+                    name=pod_name,
+                    namespace=namespace,
+                    _request_timeout=KUBE_REQUEST_TIMEOUT,
+                )
+                return existing
+            except client.exceptions.ApiException as read_e:
+                logger.error(f"Failed to read existing pod {pod_name}: {read_e}")
+                raise
+        logger.error(f"Exception when creating pod: {e}")
+        raise
+
+
+POD_FINISHED_PHASES = ["Succeeded", "Failed"]
+POD_LOG_TAIL_LINES = 50
+
+
+def _wait_pod_finished(v1, pod, namespace, timeout):
+    """Watch pod until it reaches a finished phase; return the final pod."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    resource_version = pod.metadata.resource_version
+    while pod.status.phase not in POD_FINISHED_PHASES:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(
+                f"Pod {pod.metadata.name} did not finish within {timeout:.0f}s"
+            )
+        timeout_seconds = max(1, int(remaining or INFORMER_RESYNC))
+        stream = watch.Watch().stream(
+            v1.list_namespaced_pod,
+            namespace,
+            field_selector=f"metadata.name={pod.metadata.name}",
+            resource_version=resource_version,
+            timeout_seconds=timeout_seconds,
+            _request_timeout=timeout_seconds + KUBE_REQUEST_TIMEOUT,
+        )
+        for event in stream:
+            if event["type"] == "DELETED":
+                raise client.exceptions.ApiException(status=404, reason="Pod deleted")
+            pod = event["object"]
+            resource_version = pod.metadata.resource_version
+            logger.info(f"Pod {pod.metadata.name} is in phase: {pod.status.phase}")
+            if pod.status.phase in POD_FINISHED_PHASES:
+                break
+    return pod
+
+
+def _log_pod_failure(v1, pod, namespace):
+    exit_codes = [
+        status.state.terminated.exit_code
+        for status in pod.status.container_statuses or []
+        if status.state and status.state.terminated
+    ]
+    try:
+        logs = v1.read_namespaced_pod_log(
+            name=pod.metadata.name,
+            namespace=namespace,
+            tail_lines=POD_LOG_TAIL_LINES,
+            _request_timeout=KUBE_REQUEST_TIMEOUT,
+        )
+    except client.exceptions.ApiException as e:
+        logs = f"<logs unavailable: {e.reason}>"
+    logger.error(
+        f"Pod {pod.metadata.name} failed with exit code(s) {exit_codes}, logs:\n{logs}"
+    )
+
+
+def _delete_pod_in_background(v1, pod_name, namespace):
+    def delete():
+        try:
+            v1.delete_namespaced_pod(
+                name=pod_name, namespace=namespace, _request_timeout=KUBE_REQUEST_TIMEOUT
+            )
+        except client.exceptions.ApiException as e:
+            if getattr(e, "status", None) != 404:
+                logger.error(f"Exception when deleting pod {pod_name}: {e}")
+
+    threading.Thread(target=delete, name=f"delete-{pod_name}", daemon=True).start()
+
+
+def cleanup_pod(pod_name, namespace="default", timeout=None):
+    """Wait for pod to finish, then delete it without waiting for the deletion.
+
+    Returns whether the pod succeeded. Raises TimeoutError if it is still
+    running after timeout seconds; the pod is then left for a retry.
+    """
+    v1 = core_v1()
+    try:
+        pod = v1.read_namespaced_pod(
+            name=pod_name, namespace=namespace, _request_timeout=KUBE_REQUEST_TIMEOUT
+        )
+        pod = _wait_pod_finished(v1, pod, namespace, timeout)
+        phase = pod.status.phase
+        logger.info(f"Pod {pod_name} has finished with phase: {phase}")
+        if phase == "Failed":
+            _log_pod_failure(v1, pod, namespace)
+        _delete_pod_in_background(v1, pod_name, namespace)
+        return phase == "Succeeded"
+    except client.exceptions.ApiException as e:
+        if getattr(e, "status", None) == 404:
+            logger.info(f"Pod {pod_name} not found in namespace {namespace}, nothing to clean up")
+            return True
+        logger.error(f"Exception when monitoring or deleting pod: {e}")
+        raise
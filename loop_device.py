@@ -0,0 +1,338 @@
+import errno
+import fcntl
+import glob
+import os
+import stat
+import struct
+import threading
+from contextlib import contextmanager
+from mounts import mount_table
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+LOOP_CONTROL = "/dev/loop-control"
+SYS_LOOP_BACKING_FILES = "/sys/block/loop*/loop/backing_file"
+DELETED_SUFFIX = " (deleted)"
+LOOP_MAJOR = 7
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_SET_CAPACITY = 0x4C07
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_SET_BLOCK_SIZE = 0x4C09
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+
+LO_NAME_SIZE = 64
+# struct loop_info64: device, inode, rdevice, offset, sizelimit, number,
+# encrypt_type, encrypt_key_size, flags, file_name, crypt_name,
+# encrypt_key, init[2]
+LOOP_INFO64 = struct.Struct("=5Q4I64s64s32s2Q")
+# struct loop_config: fd, block_size, info, __reserved[8]
+LOOP_CONFIG = struct.Struct(f"=II{LOOP_INFO64.size}s8Q")
+
+# a free device can be taken by a concurrent attach between
+# LOOP_CTL_GET_FREE and LOOP_CONFIGURE; give up after this many races
+ATTACH_RETRIES = 16
+
+
+def _loop_info(file_path, flags):
+    name = os.fsencode(file_path)[: LO_NAME_SIZE - 1]
+    return LOOP_INFO64.pack(0, 0, 0, 0, 0, 0, 0, 0, flags, name, b"", b"", 0, 0)
+
+
+def _ensure_node(number):
+    device = f"/dev/loop{number}"
+    if not os.path.exists(device):
+        # containers with a static /dev do not get nodes for new loop devices
+        try:
+            os.mknod(device, stat.S_IFBLK | 0o660, os.makedev(LOOP_MAJOR, number))
+        except FileExistsError:
+            # LOOP_CTL_GET_FREE does not reserve the device, so a
+            # concurrent attach may have been handed the same number
+            pass
+    return device
+
+
+def _configure_legacy(loop_fd, backing_fd, file_path, flags, block_size):
+    """LOOP_SET_FD + LOOP_SET_STATUS64 for kernels without LOOP_CONFIGURE (< 5.8)."""
+    fcntl.ioctl(loop_fd, LOOP_SET_FD, backing_fd)
+    try:
+        fcntl.ioctl(
+            loop_fd,
+            LOOP_SET_STATUS64,
+            _loop_info(file_path, flags & ~LO_FLAGS_DIRECT_IO),
+        )
+        if block_size:
+            fcntl.ioctl(loop_fd, LOOP_SET_BLOCK_SIZE, block_size)
+        if flags & LO_FLAGS_DIRECT_IO:
+            fcntl.ioctl(loop_fd, LOOP_SET_DIRECT_IO, 1)
+    except OSError:
+        fcntl.ioctl(loop_fd, LOOP_CLR_FD, 0)
+        raise
+
+
+def _configure(loop_fd, backing_fd, file_path, flags, block_size):
+    config = LOOP_CONFIG.pack(
+        backing_fd, block_size, _loop_info(file_path, flags), *([0] * 8)
+    )
+    try:
+        fcntl.ioctl(loop_fd, LOOP_CONFIGURE, config)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.ENOTTY):
+            raise
+        _configure_legacy(loop_fd, backing_fd, file_path, flags, block_size)
+
+
+@contextmanager
+def attached(file_path, direct_io=True, block_size=0, autoclear=False, read_only=False):
+    """Attach file_path to a free loop device and yield the device path.
+
+    The device is held open inside the block. With autoclear the kernel
+    detaches it as soon as its last user goes away, so anything that
+    should keep it (a mount) has to be set up inside the block.
+    """
+    flags = 0
+    if direct_io:
+        flags |= LO_FLAGS_DIRECT_IO
+    if autoclear:
+        flags |= LO_FLAGS_AUTOCLEAR
+    if read_only:
+        flags |= LO_FLAGS_READ_ONLY
+    backing_fd = os.open(file_path, os.O_RDONLY if read_only else os.O_RDWR)
+    try:
+        control_fd = os.open(LOOP_CONTROL, os.O_RDWR)
+        try:
+            for _ in range(ATTACH_RETRIES):
+                number = fcntl.ioctl(control_fd, LOOP_CTL_GET_FREE)
+                device = _ensure_node(number)
+                loop_fd = os.open(device, os.O_RDWR)
+                try:
+                    _configure(loop_fd, backing_fd, file_path, flags, block_size)
+                except OSError as e:
+                    os.close(loop_fd)
+                    if e.errno == errno.EBUSY:
+                        continue
+                    raise
+                break
+            else:
+                raise OSError(
+                    errno.EBUSY, f"No free loop device after {ATTACH_RETRIES} attempts"
+                )
+        finally:
+            os.close(control_fd)
+    finally:
+        os.close(backing_fd)
+    logger.info(f"Attached {file_path} to {device}")
+    loop_index.added(device, file_path)
+    try:
+        yield device
+    finally:
+        os.close(loop_fd)
+
+
+def attach(file_path, direct_io=True, block_size=0, read_only=False):
+    with attached(file_path, direct_io, block_size, read_only=read_only) as device:
+        return device
+
+
+def detach(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+    finally:
+        os.close(fd)
+    loop_index.removed(device)
+    logger.info(f"Detached {device}")
+
+
+def set_capacity(device):
+    """Make the loop device pick up the new size of its backing file."""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, LOOP_SET_CAPACITY, 0)
+    finally:
+        os.close(fd)
+
+
+def _sys_attr(device, attr):
+    return f"/sys/block/{os.path.basename(device)}/{attr}"
+
+
+def direct_io_enabled(device):
+    """Whether the kernel really does direct I/O for device.
+
+    LO_FLAGS_DIRECT_IO is only a request: the kernel quietly stays on
+    buffered I/O when the loop block size is smaller than the logical
+    block size of the backing device or the backing file cannot do
+    O_DIRECT.
+    """
+    with open(_sys_attr(device, "loop/dio")) as f:
+        return f.read().strip() == "1"
+
+
+def set_queue_attribute(device, name, value):
+    with open(_sys_attr(device, f"queue/{name}"), "w") as f:
+        f.write(str(value))
+
+
+def _file_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+def _decode_dev(dev):
+    """dev_t from the kernel's new_encode_dev() encoding in loop_info64."""
+    major = (dev & 0xFFF00) >> 8
+    minor = (dev & 0xFF) | ((dev >> 12) & 0xFFF00)
+    return os.makedev(major, minor)
+
+
+def _backing_key(device):
+    """(st_dev, st_ino) of the backing file of device, None if it has none.
+
+    Unlike the path in sysfs, which is the one the attaching process saw,
+    this identifies the file from any mount namespace.
+    """
+    try:
+        fd = os.open(device, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        info = fcntl.ioctl(fd, LOOP_GET_STATUS64, bytes(LOOP_INFO64.size))
+    except OSError:
+        # ENXIO: not attached
+        return None
+    finally:
+        os.close(fd)
+    lo_device, lo_inode = LOOP_INFO64.unpack(info)[:2]
+    return (_decode_dev(lo_device), lo_inode)
+
+
+def _backing_file(device):
+    name = os.path.basename(device)
+    try:
+        with open(f"/sys/block/{name}/loop/backing_file") as f:
+            return f.read().rstrip("\n")
+    except OSError:
+        return None
+
+
+class LoopIndex:
+    """Index of attached loop devices by backing file identity.
+
+    Built once from the attached devices in /sys/block/loop* and then
+    updated by attach() and detach(). Backing files are keyed by the
+    (device, inode) the kernel reports with LOOP_GET_STATUS64, so
+    different paths to the same image, including paths from the mount
+    namespace of a previous plugin instance, resolve to the same devices.
+    Entries are checked against the kernel on lookup because autoclear
+    devices are detached behind our back.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._devices = {}
+        self._by_key = {}
+
+    def _add(self, device, key, path):
+        self._devices[device] = (key, path)
+        if key is not None:
+            self._by_key.setdefault(key, set()).add(device)
+
+    def _remove(self, device):
+        key, _ = self._devices.pop(device, (None, None))
+        if key is not None:
+            self._by_key.get(key, set()).discard(device)
+
+    def load(self):
+        with self._lock:
+            self._devices = {}
+            self._by_key = {}
+            for backing in glob.glob(SYS_LOOP_BACKING_FILES):
+                device = "/dev/" + backing.split("/")[3]
+                with open(backing) as f:
+                    path = f.read().rstrip("\n")
+                self._add(device, _backing_key(device), path)
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def added(self, device, path):
+        self._ensure_loaded()
+        with self._lock:
+            self._remove(device)
+            self._add(device, _file_key(path), os.path.realpath(path))
+
+    def removed(self, device):
+        self._ensure_loaded()
+        with self._lock:
+            self._remove(device)
+
+    def _valid(self, device, key):
+        return key is not None and _backing_key(device) == key
+
+    def devices_of(self, file_path):
+        """Loop devices backed by file_path, attached ones only."""
+        self._ensure_loaded()
+        key = _file_key(file_path)
+        if key is None:
+            return []
+        devices = []
+        with self._lock:
+            for device in sorted(self._by_key.get(key, ())):
+                if self._valid(device, key):
+                    devices.append(device)
+                else:
+                    self._remove(device)
+        return devices
+
+    def backing_file_of(self, device):
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._devices.get(device)
+        if entry is None or not self._valid(device, entry[0]):
+            return None
+        return entry[1]
+
+    def attached(self):
+        self._ensure_loaded()
+        with self._lock:
+            return {device: path for device, (_, path) in self._devices.items()}
+
+    def leaks(self):
+        """Attached loop devices whose backing file was deleted or that
+        no mount uses (the latter includes staged raw block volumes that
+        are not published yet)."""
+        in_use = set()
+        for entry in mount_table.entries():
+            in_use.add(entry["source"])
+            # a device node bind mount shows up with the node as its root
+            if entry["root"].startswith("/loop"):
+                in_use.add("/dev" + entry["root"])
+        orphaned, unused = [], []
+        for device, path in self.attached().items():
+            backing = _backing_file(device)
+            if backing is None:
+                self.removed(device)
+            elif backing.endswith(DELETED_SUFFIX):
+                orphaned.append(device)
+            elif device not in in_use:
+                unused.append(device)
+        return {"orphaned": orphaned, "unused": unused}
+
+
+loop_index = LoopIndex()
@@ -1,15 +1,69 @@
+import time
 import grpc
 from concurrent import futures
 from csi import csi_pb2_grpc
 from lsdisk_service import IdentityService, ControllerService, NodeService
-from utils import get_node_name
+from utils import get_node_name, rpc_deadline
+from kube import start_informers
+from disk_inventory import inventory_cache
+from lsdisk_utils import backing_mounts
+from loop_device import loop_index
+from capacity_ledger import ledger
+from image_pool import image_pool
+from snapshots import thaw_volumes
+import metrics
 from logger import get_logger
+from constance.config import GRPC_MAX_WORKERS, METRICS_PORT
 
 logger = get_logger(__name__)
 
 
+class DeadlineInterceptor(grpc.ServerInterceptor):
+    """Ties commands run by an RPC to its deadline and times every RPC."""
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or handler.unary_unary is None:
+            return handler
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        behavior = handler.unary_unary
+
+        def timed_behavior(request, context):
+            start = time.monotonic()
+            try:
+                with rpc_deadline(context.time_remaining()):
+                    return behavior(request, context)
+            finally:
+                metrics.observe(
+                    "rpc_duration_seconds", time.monotonic() - start, method=method
+                )
+
+        return grpc.unary_unary_rpc_method_handler(
+            timed_behavior,
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+
+
 def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    start_informers()
+    inventory_cache.start()
+    backing_mounts.adopt()
+    loop_index.load()
+    leaks = loop_index.leaks()
+    if leaks["orphaned"] or leaks["unused"]:
+        logger.warning(
+            f"Loop devices with deleted backing files: {leaks['orphaned']}, not mounted anywhere: {leaks['unused']}"
+        )
+    thaw_volumes()
+    ledger.start()
+    image_pool.start()
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS),
+        interceptors=[DeadlineInterceptor()],
+    )
     csi_pb2_grpc.add_IdentityServicer_to_server(IdentityService(), server)
     csi_pb2_grpc.add_ControllerServicer_to_server(ControllerService(), server)
     csi_pb2_grpc.add_NodeServicer_to_server(
@@ -1,46 +1,167 @@
+import os
 import shutil
+import stat
+import threading
+from contextlib import contextmanager
 import grpc
 from csi import csi_pb2_grpc, csi_pb2
 from google.protobuf.wrappers_pb2 import BoolValue
+from google.protobuf.timestamp_pb2 import Timestamp
 from lsdisk_utils import (
+    expand_img,
     extend_fs,
     find_disk,
-    get_device_with_most_free_space,
     create_img,
+    clone_img,
+    find_fstype,
     mount_device,
     path_stats,
     umount_device,
-    attach_loop,
+    attached_loop,
     detach_loops,
     mount_bind,
+    mount_block,
+    block_device_size,
+    attach_loop,
+    attached_loops_dev,
     find_loop_from_path,
     find_RAID_disks,
-    get_full_free_spaces
+    backing_mounts,
+    loop_block_size,
+    queue_context,
+    queue_settings,
+    PROVISIONING_MODES,
+    SPARSE,
+)
+from capacity_ledger import (
+    MIN_SIZE,
+    ledger,
+    get_available_capacity,
+    locate_volume,
+    placement_context,
 )
-from utils import (
+import filesystems
+from image_pool import image_pool
+from image_copy import ReflinkUnsupported
+from snapshots import (
+    SNAPSHOT_DIR,
+    FreezeTimeout,
+    SnapshotExists,
+    create_snapshot,
+    delete_snapshot,
+    list_snapshots,
+    parse_snapshot_id,
+    read_snapshot,
+)
+from placement import reserve_disk, STRATEGIES, DEFAULT_STRATEGY
+from disk_inventory import get_inventory
+from utils import get_node_name, be_absent, InFlight
+import loop_device
+from kube import (
     get_node_from_pv,
+    get_storageclasses,
     get_storageclass_from_pv,
     get_storageclass_storagemodel_param,
     get_storageclass_disktype_param,
-    get_node_name,
-    be_absent,
-    run,
     run_pod,
     cleanup_pod,
 )
-from constance.config import IMAGE_NAME, MOUNT_DEST, POD_IMAGE,NAMESPACE
+from constance.config import (
+    IMAGE_NAME,
+    MOUNT_DEST,
+    POD_IMAGE,
+    NAMESPACE,
+    EXPANSION_MODE,
+    GRPC_MAX_WORKERS,
+)
 from pathlib import Path
 from logger import get_logger
 from kubernetes.client.exceptions import ApiException
 
 logger = get_logger(__name__)
 NODE_NAME_TOPOLOGY_KEY = "hostname"
+DRIVER_NAME = "lsdisk.driver"
+
+# CreateVolume retries join the create of the same volume that is running
+create_operations = InFlight(GRPC_MAX_WORKERS, "create-volume")
+snapshot_operations = InFlight(GRPC_MAX_WORKERS, "create-snapshot")
+
+
+_expand_locks = {}
+_expand_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _expand_lock(volume_id):
+    with _expand_locks_lock:
+        lock = _expand_locks.setdefault(volume_id, threading.Lock())
+    with lock:
+        yield
+
+
+def find_disks_of_pv(pvname):
+    storageclass = get_storageclass_from_pv(pvname)
+    storagemodel = get_storageclass_storagemodel_param(
+        storageclass_name=storageclass
+    )
+    if storagemodel.startswith("LOGICAL"):
+        disktype = get_storageclass_disktype_param(
+            storageclass_name=storageclass
+        )
+        return find_RAID_disks(storage_model=storagemodel, disk_type=disktype)
+    return find_disk(storage_model=storagemodel)
+
+
+def find_snapshot_disks():
+    """Backing disks snapshots can be on: the disks of every lsdisk
+    StorageClass and any disk that is mounted already."""
+    disks = set(backing_mounts.mounted())
+    try:
+        storage_classes = get_storageclasses(DRIVER_NAME)
+    except ApiException as e:
+        logger.warning(f"Cannot list StorageClasses ({e}), only listing mounted disks")
+        storage_classes = []
+    for storage_class in storage_classes:
+        parameters = storage_class["parameters"]
+        storage_model = parameters.get("storagemodel", "")
+        if storage_model.startswith("LOGICAL"):
+            disks.update(find_RAID_disks(storage_model, parameters.get("disk_type", "")))
+        else:
+            disks.update(find_disk(storage_model))
+    return sorted(disks)
+
+
+def find_content_source(source):
+    """(disk, image path relative to its mount) of a volume content source."""
+    if source.HasField("snapshot"):
+        disk, name = parse_snapshot_id(source.snapshot.snapshot_id)
+        return disk, f"{SNAPSHOT_DIR}/{name}/{IMAGE_NAME}"
+    volume = source.volume.volume_id
+    try:
+        disk = locate_volume(volume, find_candidates=lambda: find_disks_of_pv(volume))
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        disk = None
+    return disk, f"{volume}/{IMAGE_NAME}"
+
+
+def snapshot_message(snapshot):
+    creation_time = Timestamp()
+    creation_time.FromNanoseconds(int(snapshot["creation_time"] * 1e9))
+    return csi_pb2.Snapshot(
+        size_bytes=snapshot["size"],
+        snapshot_id=snapshot["snapshot_id"],
+        source_volume_id=snapshot["source_volume_id"],
+        creation_time=creation_time,
+        ready_to_use=True,
+    )
 
 
 class IdentityService(csi_pb2_grpc.IdentityServicer):
     def GetPluginInfo(self, request, context):
         return csi_pb2.GetPluginInfoResponse(
-            name="lsdisk.driver", vendor_version="1.0.0"
+            name=DRIVER_NAME, vendor_version="1.0.0"
         )
 
     def GetPluginCapabilities(self, request, context):
@@ -88,48 +209,185 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
         node_name = request.accessibility_requirements.preferred[0].segments[
             NODE_NAME_TOPOLOGY_KEY
         ]
-        MIN_SIZE = 16 * 1024 * 1024  # 16MiB
-        size = max(MIN_SIZE, request.capacity_range.required_bytes)
         storage_model = parameters.get("storagemodel", "")
         disk_type = parameters.get("disk_type", "")
         full_disk = parameters.get("full_disk", "").lower()
+        placement = parameters.get("placement", DEFAULT_STRATEGY)
+        provisioning = parameters.get("provisioning", SPARSE)
         logger.info(f"Storage model: {storage_model}")
         logger.info(f"Disk_type: {disk_type}")
         logger.info(f"Full_disk: {full_disk}")
+        logger.info(f"Placement: {placement}")
+        logger.info(f"Provisioning: {provisioning}")
+        if placement not in STRATEGIES:
+            context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Unsupported placement: {placement}",
+            )
+        if provisioning not in PROVISIONING_MODES:
+            context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"Unsupported provisioning: {provisioning}",
+            )
+        block = volume_capability.HasField("block")
+        fs_type = mount_options = ""
+        mkfs_options = []
+        try:
+            tuning = queue_context(parameters)
+            if not block:
+                fs_type = volume_capability.mount.fs_type or parameters.get(
+                    "fsType", filesystems.DEFAULT_FS
+                )
+                mount_options = parameters.get("mountOptions", "")
+                mkfs_options = filesystems.parse_mkfs_options(
+                    fs_type, parameters.get("mkfsOptions", "")
+                )
+                filesystems.parse_mount_options(
+                    fs_type, [mount_options, *volume_capability.mount.mount_flags]
+                )
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        logger.info(f"Block: {block}, FsType: {fs_type}, mkfs options: {mkfs_options}")
+        size = max(
+            filesystems.MIN_SIZE.get(fs_type, MIN_SIZE),
+            request.capacity_range.required_bytes,
+        )
+
+        source = request.volume_content_source
+        source_disk = source_image = None
+        if source.HasField("snapshot") or source.HasField("volume"):
+            source_disk, source_image = find_content_source(source)
+            if source_disk:
+                with backing_mounts.use(source_disk) as path:
+                    source_file = f"{path}/{source_image}"
+                    if os.path.isfile(source_file):
+                        source_size = os.path.getsize(source_file)
+                        source_fs = find_fstype(source_file)
+                    else:
+                        source_disk = None
+            if not source_disk:
+                context.abort(
+                    grpc.StatusCode.NOT_FOUND,
+                    f"Content source of volume {request.name} not found on this node",
+                )
+            if request.capacity_range.required_bytes and (
+                request.capacity_range.required_bytes < source_size
+            ):
+                context.abort(
+                    grpc.StatusCode.OUT_OF_RANGE,
+                    f"Requested size is smaller than the source size {source_size}",
+                )
+            if not block and source_fs != fs_type:
+                context.abort(
+                    grpc.StatusCode.INVALID_ARGUMENT,
+                    f"Source filesystem {source_fs} does not match fsType {fs_type}",
+                )
+            size = max(size, source_size)
 
         # Find and select disk
         if storage_model.startswith("LOGICAL"):
             disks = find_RAID_disks(storage_model, disk_type)
         else:
             disks = find_disk(storage_model)
-        if full_disk.lower() == "true":
-            disk = (
-                get_full_free_spaces(disks, size)
+
+        def provision():
+            ledger.ensure(disks)
+            # a retry of a create that finished, or was interrupted by a
+            # restart, completes the volume where it was placed
+            disk = ledger.locate(request.name)
+            reservation = None
+            if disk:
+                logger.info(f"Volume {request.name} is already on disk {disk}")
+            elif (
+                source_disk in disks
+                and full_disk != "true"
+                and ledger.available(source_disk) >= size
+            ):
+                # on the filesystem of the source the copy can be a reflink
+                disk, reservation = reserve_disk([source_disk], size, placement)
+            if not disk:
+                disk, reservation = reserve_disk(
+                    disks, size, placement, full_disk=full_disk == "true"
+                )
+            if not disk:
+                return "", size
+            logger.info(f"Selected disk: {disk}")
+            volume_size = size
+
+            # Create volume on the backing disk
+            try:
+                with backing_mounts.use(disk) as path:
+                    if full_disk == "true" and reservation is not None:
+                        usage = shutil.disk_usage(path)
+                        volume_size = usage.free
+                        logger.info(f"Using full disk size: {volume_size} bytes")
+                    # pooled images are sparse ext4 made with the default options
+                    pooled = (
+                        image_pool.enabled
+                        and reservation is not None
+                        and not source_disk
+                        and not block
+                        and full_disk != "true"
+                        and provisioning == SPARSE
+                        and fs_type == filesystems.DEFAULT_FS
+                        and not mkfs_options
+                        and image_pool.claim(path, request.name, volume_size)
+                    )
+                    if source_disk:
+                        with backing_mounts.use(source_disk) as source_path:
+                            clone_img(
+                                path=f"{path}/{request.name}",
+                                source=f"{source_path}/{source_image}",
+                                size=volume_size,
+                            )
+                    elif not pooled:
+                        create_img(
+                            path=f"{path}/{request.name}",
+                            size=volume_size,
+                            provisioning=provisioning,
+                            fstype=fs_type or None,
+                            mkfs_options=mkfs_options,
+                        )
+                    volume_size = os.path.getsize(f"{path}/{request.name}/{IMAGE_NAME}")
+            except Exception:
+                if reservation is not None:
+                    ledger.release(reservation)
+                raise
+            if reservation is not None:
+                ledger.commit(reservation, request.name)
+            return disk, volume_size
+
+        try:
+            disk, size = create_operations.do(
+                request.name, provision, timeout=context.time_remaining()
             )
-        else:
-            disk = (
-                 get_device_with_most_free_space(disks)
+        except TimeoutError:
+            context.abort(
+                grpc.StatusCode.DEADLINE_EXCEEDED,
+                f"Creating volume {request.name} is still in progress",
+            )
+        except FreezeTimeout as e:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                f"{e}, the copy of the content source was abandoned",
             )
         if not disk:
             context.abort(
                 grpc.StatusCode.RESOURCE_EXHAUSTED, "No disk with specified model found"
             )
 
-        logger.info(f"Selected disk: {disk}")
-        path = Path(f"{MOUNT_DEST}/{str(storage_model).replace(" ","")}-{request.name}")
-
-        # Create and mount volume
-        mount_device(src=f"/dev/{disk}", dest=path)
-        if full_disk.lower() == "true":
-            usage = shutil.disk_usage(path)
-            size = usage.free
-            logger.info(f"Using full disk size: {size} bytes")
-        create_img(path=f"{path}/{request.name}", size=size)
-        umount_device(dest=path)
-
         volume = csi_pb2.Volume(
             volume_id=request.name,
             capacity_bytes=size,
+            volume_context={
+                **placement_context(disk),
+                **tuning,
+                filesystems.FS_TYPE_KEY: fs_type,
+                filesystems.MOUNT_OPTIONS_KEY: mount_options,
+                # a copy may be larger than the filesystem it holds
+                filesystems.GROW_FS_KEY: "true" if source_disk and not block else "",
+            },
+            content_source=source if source_disk else None,
             accessible_topology=[
                 csi_pb2.Topology(segments={NODE_NAME_TOPOLOGY_KEY: node_name})
             ],
@@ -139,7 +397,10 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
     def DeleteVolume(self, request, context):
         logger.info(f"DeleteVolume request for pv {request.volume_id}")
         try:
-            storageclass = get_storageclass_from_pv(pvname=request.volume_id)
+            disk = locate_volume(
+                request.volume_id,
+                find_candidates=lambda: find_disks_of_pv(request.volume_id),
+            )
         except ApiException as e:
             if e.status == 404:
                 logger.info(
@@ -150,29 +411,19 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
                 logger.error(f"Error reading PV {request.volume_id}: {e}")
                 context.abort(grpc.StatusCode.INTERNAL, str(e))
 
-        storagemodel = get_storageclass_storagemodel_param(
-            storageclass_name=storageclass
-        )
-        if storagemodel.startswith("LOGICAL"):
-            disktype = get_storageclass_disktype_param(
-                storageclass_name=storageclass
-            )
-            logger.info(f"Disk type for deletion: {disktype}")
-            disks = find_RAID_disks(storage_model=storagemodel, disk_type=disktype)
-        else:
-            disks = find_disk(storage_model=storagemodel)
-        for disk in disks:
-            path = f"{MOUNT_DEST}/{storagemodel.replace(" ","")}-{request.volume_id}"
-            mount_device(src=f"/dev/{disk}", dest=path)
-            is_deleted = be_absent(f"{path}/{request.volume_id}")
-            umount_device(path)
+        if disk:
+            with backing_mounts.use(disk) as path:
+                is_deleted = be_absent(f"{path}/{request.volume_id}")
             if is_deleted:
                 logger.info(f"Image file {request.volume_id} deleted")
-                break
+                ledger.remove_volume(request.volume_id)
 
         return csi_pb2.DeleteVolumeResponse()
 
     def GetCapacity(self, request, context):
+        # GetCapacity is polled continuously, which makes it a cheap place to
+        # let go of backing disks that were pulled from the node
+        backing_mounts.prune(get_inventory()["disks"])
         parameters = request.parameters
         storage_model = parameters.get("storagemodel", "")
         disk_type = parameters.get("disk_type", "")
@@ -182,22 +433,18 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
         else:
             disks = find_disk(storage_model)
 
-        disk = (
-            get_device_with_most_free_space(disks)
-        )
-
-        if disk:
-            path = f"{MOUNT_DEST}/{disk}"
-            mount_device(src=f"/dev/{disk}", dest=path)
-            available_capacity = shutil.disk_usage(path).free
-            umount_device(dest=path)
-        else:
-            available_capacity = 0
+        available_capacity = get_available_capacity(disks)
 
         return csi_pb2.GetCapacityResponse(available_capacity=available_capacity)
 
     def ControllerExpandVolume(self, request, context):
         logger.info(f"ControllerExpandVolume request for pv {request.volume_id}")
+        if EXPANSION_MODE == "node":
+            # the image is grown by the node plugin in NodeExpandVolume
+            return csi_pb2.ControllerExpandVolumeResponse(
+                capacity_bytes=request.capacity_range.required_bytes,
+                node_expansion_required=True,
+            )
         try:
             storageclass = get_storageclass_from_pv(pvname=request.volume_id)
             node_name = get_node_from_pv(request.volume_id)
@@ -238,20 +485,141 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
             command=["python", "/app/extend_image.py"],
             env_vars=env_vars,
         )
-        is_deleted = cleanup_pod(pod_name=request.volume_id,namespace=NAMESPACE)
+        try:
+            succeeded = cleanup_pod(
+                pod_name=request.volume_id,
+                namespace=NAMESPACE,
+                timeout=context.time_remaining(),
+            )
+        except TimeoutError as e:
+            context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, str(e))
 
-        if is_deleted:
-            logger.info(f"Pod {request.volume_id} deleted")
+        if succeeded:
+            logger.info(f"Pod {request.volume_id} finished")
             return csi_pb2.ControllerExpandVolumeResponse(
                 capacity_bytes=request.capacity_range.required_bytes,
                 node_expansion_required=True,
             )
         else:
             context.abort(
-                grpc.StatusCode.RESOURCE_EXHAUSTED,
-                "No disk with specified model found",
+                grpc.StatusCode.INTERNAL,
+                f"Expansion pod {request.volume_id} failed",
             )
 
+    def CreateSnapshot(self, request, context):
+        logger.info(
+            f"CreateSnapshot request {request.name} for pv {request.source_volume_id}"
+        )
+        volume = request.source_volume_id
+        try:
+            disk = locate_volume(
+                volume, find_candidates=lambda: find_disks_of_pv(volume)
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            disk = None
+        if not disk:
+            context.abort(
+                grpc.StatusCode.NOT_FOUND, f"Image of volume {volume} not found"
+            )
+
+        # fallback: copy allows a full (sparse) copy where reflinks are not supported
+        allow_copy = request.parameters.get("fallback", "") == "copy"
+
+        def take():
+            with backing_mounts.use(disk) as path:
+                return create_snapshot(disk, path, request.name, volume, allow_copy)
+
+        # a retry while the snapshot is copied joins the copy instead of
+        # deleting its half written directory
+        try:
+            snapshot = snapshot_operations.do(
+                request.name, take, timeout=context.time_remaining()
+            )
+        except TimeoutError:
+            context.abort(
+                grpc.StatusCode.DEADLINE_EXCEEDED,
+                f"Snapshot {request.name} is still being taken",
+            )
+        except ReflinkUnsupported as e:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                f"{e}. The filesystem of /dev/{disk} does not support reflinks, "
+                "use XFS with reflink=1 or set fallback: copy in the VolumeSnapshotClass",
+            )
+        except FreezeTimeout as e:
+            context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION,
+                f"{e}, the copy of volume {volume} was abandoned. "
+                "Raise SNAPSHOT_FREEZE_TIMEOUT or use a filesystem with reflinks",
+            )
+        except SnapshotExists as e:
+            context.abort(grpc.StatusCode.ALREADY_EXISTS, str(e))
+        if snapshot["source_volume_id"] != volume:
+            context.abort(
+                grpc.StatusCode.ALREADY_EXISTS,
+                f"Snapshot {request.name} already exists for volume {snapshot['source_volume_id']}",
+            )
+        return csi_pb2.CreateSnapshotResponse(snapshot=snapshot_message(snapshot))
+
+    def DeleteSnapshot(self, request, context):
+        logger.info(f"DeleteSnapshot request for {request.snapshot_id}")
+        disk, name = parse_snapshot_id(request.snapshot_id)
+        if name is None:
+            logger.info(f"Invalid snapshot id {request.snapshot_id}, nothing to delete.")
+            return csi_pb2.DeleteSnapshotResponse()
+        if not disk:
+            # the disk may only be gone for now; failing keeps the delete retried
+            context.abort(
+                grpc.StatusCode.UNAVAILABLE,
+                f"Disk of snapshot {request.snapshot_id} not found on this node",
+            )
+        with backing_mounts.use(disk) as path:
+            delete_snapshot(path, name)
+        return csi_pb2.DeleteSnapshotResponse()
+
+    def ListSnapshots(self, request, context):
+        if request.snapshot_id:
+            disk, name = parse_snapshot_id(request.snapshot_id)
+            disks = [disk] if disk else []
+        else:
+            # disks nothing has mounted since the plugin started are
+            # mounted by loading them into the ledger
+            disks = find_snapshot_disks()
+            ledger.ensure(disks)
+            disks = ledger.usable(disks)
+        snapshots = []
+        for disk in disks:
+            with backing_mounts.use(disk) as path:
+                if request.snapshot_id:
+                    snapshot = read_snapshot(disk, path, name)
+                    snapshots += [snapshot] if snapshot else []
+                else:
+                    snapshots += list_snapshots(disk, path)
+        if request.source_volume_id:
+            snapshots = [
+                snapshot
+                for snapshot in snapshots
+                if snapshot["source_volume_id"] == request.source_volume_id
+            ]
+        snapshots.sort(key=lambda snapshot: snapshot["snapshot_id"])
+
+        try:
+            start = int(request.starting_token or 0)
+        except ValueError:
+            context.abort(
+                grpc.StatusCode.ABORTED, f"Invalid starting_token {request.starting_token}"
+            )
+        end = start + request.max_entries if request.max_entries else len(snapshots)
+        return csi_pb2.ListSnapshotsResponse(
+            entries=[
+                csi_pb2.ListSnapshotsResponse.Entry(snapshot=snapshot_message(snapshot))
+                for snapshot in snapshots[start:end]
+            ],
+            next_token=str(end) if end < len(snapshots) else "",
+        )
+
     def ControllerGetCapabilities(self, request, context):
         return csi_pb2.ControllerGetCapabilitiesResponse(
             capabilities=[
@@ -265,6 +633,21 @@ class ControllerService(csi_pb2_grpc.ControllerServicer):
                         type=csi_pb2.ControllerServiceCapability.RPC.EXPAND_VOLUME
                     )
                 ),
+                csi_pb2.ControllerServiceCapability(
+                    rpc=csi_pb2.ControllerServiceCapability.RPC(
+                        type=csi_pb2.ControllerServiceCapability.RPC.CREATE_DELETE_SNAPSHOT
+                    )
+                ),
+                csi_pb2.ControllerServiceCapability(
+                    rpc=csi_pb2.ControllerServiceCapability.RPC(
+                        type=csi_pb2.ControllerServiceCapability.RPC.LIST_SNAPSHOTS
+                    )
+                ),
+                csi_pb2.ControllerServiceCapability(
+                    rpc=csi_pb2.ControllerServiceCapability.RPC(
+                        type=csi_pb2.ControllerServiceCapability.RPC.CLONE_VOLUME
+                    )
+                ),
             ]
         )
 
@@ -283,76 +666,110 @@ class NodeService(csi_pb2_grpc.NodeServicer):
 
     def NodeStageVolume(self, request, context):
         logger.info(f"NodeStageVolume request for pv {request.volume_id}")
-        storageclass = get_storageclass_from_pv(request.volume_id)
-        storagemodel = get_storageclass_storagemodel_param(
-            storageclass_name=storageclass
+        disk = locate_volume(
+            request.volume_id,
+            volume_context=request.volume_context,
+            find_candidates=lambda: find_disks_of_pv(request.volume_id),
         )
-        disktype = get_storageclass_disktype_param(
-            storageclass_name=storageclass
+        if not disk:
+            context.abort(
+                grpc.StatusCode.NOT_FOUND,
+                f"Image of volume {request.volume_id} not found",
+            )
+
+        if request.volume_capability.HasField("block"):
+            # raw block: the loop device stays attached until unstaged and is
+            # bind mounted onto the target in NodePublishVolume
+            with backing_mounts.use(disk) as path:
+                img_file = Path(f"{path}/{request.volume_id}/{IMAGE_NAME}")
+                attach_loop(
+                    img_file,
+                    block_size=loop_block_size(disk, img_file),
+                    queue=queue_settings(request.volume_context),
+                )
+            return csi_pb2.NodeStageVolumeResponse()
+
+        fs_type = request.volume_capability.mount.fs_type or request.volume_context.get(
+            filesystems.FS_TYPE_KEY, filesystems.DEFAULT_FS
         )
-        if storagemodel.startswith("LOGICAL"):
-            disktype = get_storageclass_disktype_param(
-                storageclass_name=storageclass
+        try:
+            flags, data = filesystems.parse_mount_options(
+                fs_type,
+                [
+                    request.volume_context.get(filesystems.MOUNT_OPTIONS_KEY, ""),
+                    *request.volume_capability.mount.mount_flags,
+                ],
             )
-            disks = find_RAID_disks(storage_model=storagemodel, disk_type=disktype)
-        else:
-            disks = find_disk(storage_model=storagemodel)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
 
         staging_target_path = request.staging_target_path
-        path = f"{MOUNT_DEST}/{storagemodel.replace(" ","")}-{request.volume_id}"
-        img_file = Path(f"{path}/{request.volume_id}/{IMAGE_NAME}")      
-        for disk in disks:
-            mount_device(src=f"/dev/{disk}", dest=path)
-            if img_file.is_file():
-                loop_file = attach_loop(img_file)
-                mount_device(src=loop_file, dest=staging_target_path)
-                umount_device(path)
-                break
-
-            umount_device(dest=path)
+        with backing_mounts.use(disk) as path:
+            img_file = Path(f"{path}/{request.volume_id}/{IMAGE_NAME}")
+            with attached_loop(
+                img_file,
+                block_size=loop_block_size(disk, img_file),
+                queue=queue_settings(request.volume_context),
+            ) as loop_file:
+                mount_device(
+                    src=loop_file, dest=staging_target_path, flags=flags, data=data
+                )
+                grown = img_file.parent / filesystems.FS_GROWN_MARKER
+                if (
+                    request.volume_context.get(filesystems.GROW_FS_KEY) == "true"
+                    and not grown.exists()
+                ):
+                    extend_fs(path=loop_file)
+                    grown.touch()
         return csi_pb2.NodeStageVolumeResponse()
 
     def NodeUnstageVolume(self, request, context):
         logger.info(f"NodeUnstageVolume request for pv {request.volume_id}")
+        staging_path = request.staging_target_path
+        umount_device(staging_path)
+        be_absent(staging_path)
+
         try:
-            storageclass = get_storageclass_from_pv(request.volume_id)
-            storagemodel = get_storageclass_storagemodel_param(
-                storageclass_name=storageclass
-            )            
+            disk = locate_volume(
+                request.volume_id,
+                find_candidates=lambda: find_disks_of_pv(request.volume_id),
+            )
         except ApiException as e:
             if e.status == 404:
                 logger.warning(
                     f"PV {request.volume_id} not found. Assuming it was already deleted. Returning success."
                 )
                 return csi_pb2.NodeUnstageVolumeResponse()
-        path = f"{MOUNT_DEST}/{storagemodel.replace(" ","")}-{request.volume_id}"
-        img_file = Path(f"{path}/{request.volume_id}/{IMAGE_NAME}")
-        staging_path = request.staging_target_path
-        umount_device(staging_path)
-        be_absent(staging_path)
-
-        if storagemodel.startswith("LOGICAL"):
-            disktype = get_storageclass_disktype_param(
-                storageclass_name=storageclass
-            )
-            disks = find_RAID_disks(storage_model=storagemodel, disk_type=disktype)
-        else:
-            disks = find_disk(storage_model=storagemodel)
+            raise
 
-        for disk in disks:
-            mount_device(src=f"/dev/{disk}", dest=path)
-            isfile_exist = img_file.is_file()
-            if isfile_exist:
-                detach_loops(img_file)
-                umount_device(path)
-                break
-            umount_device(path)
+        if disk:
+            with backing_mounts.use(disk) as path:
+                detach_loops(Path(f"{path}/{request.volume_id}/{IMAGE_NAME}"))
         return csi_pb2.NodeUnstageVolumeResponse()
 
     def NodePublishVolume(self, request, context):
         logger.info(f"NodePublishVolume request for pv {request.volume_id}")
         target_path = request.target_path
         staging_path = request.staging_target_path
+        if request.volume_capability.HasField("block"):
+            disk = locate_volume(
+                request.volume_id,
+                volume_context=request.volume_context,
+                find_candidates=lambda: find_disks_of_pv(request.volume_id),
+            )
+            devices = []
+            if disk:
+                with backing_mounts.use(disk) as path:
+                    devices = attached_loops_dev(
+                        Path(f"{path}/{request.volume_id}/{IMAGE_NAME}")
+                    )
+            if not devices:
+                context.abort(
+                    grpc.StatusCode.FAILED_PRECONDITION,
+                    f"Volume {request.volume_id} is not staged",
+                )
+            mount_block(device=devices[0], dest=target_path)
+            return csi_pb2.NodePublishVolumeResponse()
         mount_bind(src=staging_path, dest=target_path)
         return csi_pb2.NodePublishVolumeResponse()
 
@@ -371,12 +788,46 @@ class NodeService(csi_pb2_grpc.NodeServicer):
         if volume_path.exists():
             logger.info(f"Volume path {volume_path} exists")
             loop = find_loop_from_path(path=volume_path)
-            run(f"losetup -c {loop}")
-            extend_fs(path=loop)
+            if not loop:
+                context.abort(
+                    grpc.StatusCode.NOT_FOUND,
+                    f"No loop device mounted at {volume_path}",
+                )
+            # concurrent or retried expansions of a volume run one at a time
+            with _expand_lock(request.volume_id):
+                if EXPANSION_MODE == "node":
+                    disk = locate_volume(
+                        request.volume_id,
+                        find_candidates=lambda: find_disks_of_pv(request.volume_id),
+                    )
+                    if not disk:
+                        context.abort(
+                            grpc.StatusCode.NOT_FOUND,
+                            f"Image of volume {request.volume_id} not found",
+                        )
+                    with backing_mounts.use(disk) as path:
+                        expand_img(volume_id=request.volume_id, size=size, root=path)
+                    ledger.resize_volume(request.volume_id)
+                loop_device.set_capacity(loop)
+                # raw block volumes have no filesystem to grow
+                if not stat.S_ISBLK(volume_path.stat().st_mode):
+                    extend_fs(path=loop)
             return csi_pb2.NodeExpandVolumeResponse(capacity_bytes=size)
+        context.abort(
+            grpc.StatusCode.NOT_FOUND, f"Volume path {volume_path} does not exist"
+        )
 
     def NodeGetVolumeStats(self, request, context):
         volume_path = request.volume_path
+        if stat.S_ISBLK(os.stat(volume_path).st_mode):
+            return csi_pb2.NodeGetVolumeStatsResponse(
+                usage=[
+                    csi_pb2.VolumeUsage(
+                        total=block_device_size(volume_path),
+                        unit=csi_pb2.VolumeUsage.Unit.BYTES,
+                    )
+                ]
+            )
         stats = path_stats(volume_path)
         return csi_pb2.NodeGetVolumeStatsResponse(
             usage=[
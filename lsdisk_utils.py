@@ -1,8 +1,20 @@
-import json
 import os
+import re
+import struct
+import time
+from contextlib import contextmanager
 from pathlib import Path
-import shutil
+import threading
+import metrics
+import loop_device
+from loop_device import loop_index
+import mounts
+from mounts import mount_table
 from utils import run, run_out
+from disk_inventory import get_inventory, HDD, SSD
+from filesystems import DEFAULT_FS, mkfs_argv
+from image_copy import copy_image
+from snapshots import frozen
 from logger import get_logger
 from constance.config import MOUNT_DEST, IMAGE_NAME
 
@@ -10,144 +22,159 @@ logger = get_logger(__name__)
     
 
 def find_disk(storage_model):
-    output = run_out("lsblk -o MODEL,NAME -d").stdout.decode()
-    lines = output.strip().split("\n")[1:]
-    result = {}
-    for line in lines:
-        parts = line.strip().split(None, 1)
-        if len(parts) < 2:
-            continue
-        model = parts[0]
-        device_name = parts[1]
-        if not is_disk_safe_to_use(device_name):
-            continue   
-        if model not in result:
-            result[model] = []
-        result[model].append(device_name)
-    return result.get(storage_model, [])
+    inventory = get_inventory()
+    return list(inventory["by_model"].get(storage_model, []))
 
 
 def is_disk_safe_to_use(device_name):
-    partition_check = run_out(f"lsblk -o NAME -n /dev/{device_name}").stdout.decode()
-    partition_lines = partition_check.strip().split("\n")
-    if len(partition_lines) > 1:
-        return False
-    
-    pv_check = run_out(f"pvs --noheadings -o pv_name 2>/dev/null | grep -w /dev/{device_name}").returncode
-    if pv_check == 0:
-        return False
-    
-    return True
+    disk = get_inventory()["disks"].get(device_name)
+    return bool(disk and disk["safe"])
 
 
 def find_RAID_disks(storage_model, disk_type):
     if disk_type == "HDD":
-        disk_type_number = 1
+        wanted_type = HDD
     else:
-        disk_type_number = 0
-    output = run_out("lsblk -o MODEL,NAME,ROTA -d").stdout.decode()
-    lines = output.strip().split("\n")[1:]
-    result = {}
-    for line in lines:
-        parts = line.strip().rsplit(None, 2)
-        if len(parts) < 3:
-            continue
-        model = parts[0]
-        device_name = parts[1]
-        dtype = parts[2]
-        if not is_disk_safe_to_use(device_name):
-            continue        
-        if model not in result:
-            result[model] = []        
-        if int(dtype) == int(disk_type_number):
-            result[model].append(device_name)
-    return result.get(storage_model, [])
-
-def get_full_free_spaces(devices, size):
-    flag_first_valid_data = False
-    min_free_space = 0
-    device_with_most_space = None
-
-    for device in devices:
-        device_path = f"/dev/{device}"
-        try:
-            path = f"{MOUNT_DEST}/{device}"
-            mount_device(src=device_path, dest=path)
-            usage = shutil.disk_usage(path)
-            free_space = usage.free
-            total_space = usage.total
-            used_space = usage.used
-            MIN_SIZE = 16 * 1024 * 1024  # 16MiB 
-            logger.info(f"Device: {device_path}, Total: {total_space}, Used: {used_space}, Free: {free_space}, size needed: {size}")        
-            if used_space < MIN_SIZE:
-                logger.info(f"Device: {device_path} is almost empty, selecting it.")
-                if not flag_first_valid_data and free_space >= size:
-                    min_free_space = free_space
-                    flag_first_valid_data = True
-                    device_with_most_space = device
-                elif flag_first_valid_data and free_space < min_free_space and free_space >= size:
-                    min_free_space = free_space
-                    device_with_most_space = device
-            umount_device(dest=path)
-        except FileNotFoundError:
-            logger.warning(f"Device {device_path} not found or inaccessible.")
-        except Exception as e:
-            logger.error(f"Error checking free space for device {device_path}: {e}")
-
-    if device_with_most_space is None:
-        logger.error("No valid devices found with free space.")
-        return ""
-    return device_with_most_space
-
-def get_device_with_most_free_space(devices):
-    max_free_space = 0
-    device_with_most_space = None
-
-    for device in devices:
-        device_path = f"/dev/{device}"
-        try:
-            path = f"{MOUNT_DEST}/{device}"
-            mount_device(src=device_path, dest=path)
-            usage = shutil.disk_usage(path)
-            free_space = usage.free
-            if free_space > max_free_space:               
-                max_free_space = free_space
-                device_with_most_space = device
-            umount_device(dest=path)
-        except FileNotFoundError:
-            logger.warning(f"Device {device_path} not found or inaccessible.")
-        except Exception as e:
-            logger.error(f"Error checking free space for device {device_path}: {e}")
-    if device_with_most_space is None:
-        return ""
-    return device_with_most_space
-
-
-def create_img(path, size):
-    path = Path(path)
-    if not path.exists():
-        path.mkdir()
+        wanted_type = SSD
+    inventory = get_inventory()
+    return list(inventory["by_model_type"].get((storage_model, wanted_type), []))
+
+SPARSE = "sparse"
+FALLOCATE = "fallocate"
+FULL = "full"
+PROVISIONING_MODES = (SPARSE, FALLOCATE, FULL)
+ZERO_CHUNK = 8 * 1024 * 1024
+
+
+def _allocate_img(img_file, size, provisioning):
+    """Create img_file of size bytes.
+
+    sparse only sets the size, fallocate reserves unwritten extents up
+    front so the filesystem can lay the image out contiguously, and full
+    also writes zeros over the whole image.
+    """
+    fd = os.open(img_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        if provisioning == SPARSE:
+            os.ftruncate(fd, size)
+            return
+        os.posix_fallocate(fd, 0, size)
+        if provisioning == FULL:
+            zeros = bytes(ZERO_CHUNK)
+            written = 0
+            while written < size:
+                written += os.write(fd, zeros[: min(ZERO_CHUNK, size - written)])
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _phase(img_file, name, provisioning):
+    start = time.monotonic()
+    yield
+    duration = time.monotonic() - start
+    metrics.observe("image_provision_seconds", duration, phase=name, provisioning=provisioning)
+    logger.info(f"{name} of {img_file} took {duration:.3f}s")
+
+
+COMPLETE_MARKER = ".complete"
+INCOMPLETE_MARKER = ".incomplete"
+
+
+def mark_incomplete(path):
+    """Record that the image in the volume directory path is being made
+    or changed, before anything is written to it."""
+    Path(f"{path}/{INCOMPLETE_MARKER}").touch()
+    Path(f"{path}/{COMPLETE_MARKER}").unlink(missing_ok=True)
+
+
+def mark_complete(path):
+    """Record that the image in the volume directory path is fully made."""
+    Path(f"{path}/{COMPLETE_MARKER}").touch()
+    Path(f"{path}/{INCOMPLETE_MARKER}").unlink(missing_ok=True)
+
+
+def image_ready(path, raw=False):
+    """Whether the volume directory path holds a finished image.
+
+    Creates mark the directory incomplete before they write the image
+    and complete once it is done. An image that is not marked complete
+    was left behind by an interrupted create or pool claim and is
+    removed so it gets made again. Only directories with neither marker,
+    which predate the markers, are adopted as they are, if their image
+    holds a filesystem.
+    """
     img_file = Path(f"{path}/{IMAGE_NAME}")
-    if img_file.is_file():
-        return
-    run(f"truncate -s {size} {img_file}")
-    run(f"mkfs.ext4 {img_file}")
-    if img_file.is_file():
-        logger.info(f"img file: {img_file} is created")
+    incomplete = Path(f"{path}/{INCOMPLETE_MARKER}").exists()
+    if not incomplete and Path(f"{path}/{COMPLETE_MARKER}").exists():
         return True
-    else:
-        logger.error(f"img file: {img_file} is not created")
+    if not img_file.is_file():
         return False
+    if not incomplete and (raw or find_fstype(img_file)):
+        logger.info(f"Adopting {img_file} created before completion markers")
+        mark_complete(path)
+        return True
+    logger.warning(f"{img_file} was not completed, recreating it")
+    img_file.unlink()
+    return False
+
+
+def create_img(path, size, provisioning=SPARSE, fstype=DEFAULT_FS, mkfs_options=()):
+    """Create the image of a volume in path; with fstype None it is left
+    without a filesystem, for raw block volumes."""
+    path = Path(path)
+    path.mkdir(exist_ok=True)
+    img_file = Path(f"{path}/{IMAGE_NAME}")
+    if image_ready(path, raw=not fstype):
+        return
+    mark_incomplete(path)
+    with _phase(img_file, "allocate", provisioning):
+        _allocate_img(img_file, int(size), provisioning)
+    if fstype:
+        with _phase(img_file, "mkfs", provisioning):
+            run(mkfs_argv(fstype, mkfs_options, img_file))
+    mark_complete(path)
+    logger.info(f"img file: {img_file} is created")
+    return True
+
+
+def clone_img(path, source, size):
+    """Create the image in path as a copy of the image file source, made
+    size bytes if that is larger. A source volume mounted on this node is
+    frozen while it is copied. The filesystem is grown when the volume
+    is staged."""
+    path = Path(path)
+    path.mkdir(exist_ok=True)
+    img_file = Path(f"{path}/{IMAGE_NAME}")
+    if image_ready(path):
+        return
+    mark_incomplete(path)
+    tmp_file = Path(f"{path}/.{IMAGE_NAME}.tmp")
+    # only one create of a volume runs at a time, so this is left over
+    # from an interrupted copy
+    tmp_file.unlink(missing_ok=True)
+    copy_image(
+        source, tmp_file, freeze=lambda timeout=None: frozen(source, timeout)
+    )
+    try:
+        if tmp_file.stat().st_size < size:
+            os.truncate(tmp_file, size)
+        os.rename(tmp_file, img_file)
+    except Exception:
+        tmp_file.unlink()
+        raise
+    mark_complete(path)
+    logger.info(f"img file: {img_file} is cloned from {source}")
 
 
 def check_mounted(dest):
-    is_mounted = run_out(f"mount | grep {dest}").stdout.decode()
-    return bool(is_mounted)
+    return mount_table.is_mounted(dest)
 
 def find_fstype(src):
-    return run_out(f"blkid -o value -s TYPE {src}").stdout.decode().strip()
+    return run_out(["blkid", "-o", "value", "-s", "TYPE", src]).stdout.decode().strip()
 
-def mount_device(src, dest):
+def mount_device(src, dest, flags=0, data=""):
     src = Path(src)
     dest = str(dest).replace(" ", "")
     dest = Path(dest)
@@ -157,11 +184,11 @@ def mount_device(src, dest):
         if not check_mounted(dest):
             fs_type = find_fstype(src)
             if fs_type in ["xfs", "ext4"]:
-                run(f"mount {src} {dest}")
+                mounts.mount(src, dest, fs_type, flags, data)
             elif fs_type == "":
                 logger.info(f"disk {src} format to ext4!")
-                run(f"mkfs.ext4 -F {src}")
-                run(f"mount {src} {dest}")
+                run(["mkfs.ext4", "-F", src])
+                mounts.mount(src, dest, "ext4", flags, data)
             else:
                 raise TypeError("Only FsType xfs and ext4 valid!")
                 
@@ -172,67 +199,269 @@ def mount_bind(src, dest):
     dest = Path(dest)
     if src.exists():
         dest.mkdir(parents=True, exist_ok=True)
-        run(f"mount --bind {src} {dest}")
+        mounts.bind(src, dest)
+
+
+def mount_block(device, dest):
+    """Bind mount the device node onto the file dest, for raw block volumes."""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.touch(exist_ok=True)
+    if not check_mounted(dest):
+        mounts.bind(device, dest)
+
+
+def block_device_size(path):
+    with open(path, "rb") as f:
+        return f.seek(0, os.SEEK_END)
 
 
 def umount_device(dest):
     if check_mounted(dest):
-        run(f"umount -l {dest}")
+        mounts.umount(dest, lazy=True)
+
+
+class BackingMounts:
+    """Keeps managed backing disks mounted under MOUNT_DEST/<disk>.
+
+    A disk is mounted the first time it is needed and stays mounted for
+    the life of the plugin; users take a reference while they work on it
+    so that a disk is only ever unmounted when nobody is using it. Mounts
+    left behind by a previous run of the plugin are adopted on startup.
+    """
+
+    def __init__(self, root=MOUNT_DEST):
+        self.root = root
+        self._lock = threading.Lock()
+        self._disk_locks = {}
+        self._mounted = set()
+        self._refs = {}
+
+    def path_of(self, disk):
+        return f"{self.root}/{disk}"
+
+    def adopt(self):
+        for entry in mount_table.entries():
+            source, target = entry["source"], entry["target"]
+            disk = source.removeprefix("/dev/")
+            if source.startswith("/dev/") and target == self.path_of(disk):
+                logger.info(f"Adopting existing mount of {source} at {target}")
+                self._mounted.add(disk)
+
+    def _disk_lock(self, disk):
+        with self._lock:
+            return self._disk_locks.setdefault(disk, threading.Lock())
+
+    def mount(self, disk):
+        """Return the mount path of disk, mounting it if needed."""
+        path = self.path_of(disk)
+        with self._disk_lock(disk):
+            if disk in self._mounted and os.path.ismount(path):
+                return path
+            mount_device(src=f"/dev/{disk}", dest=path)
+            self._mounted.add(disk)
+        return path
+
+    def mounted(self):
+        return sorted(self._mounted)
+
+    @contextmanager
+    def use(self, disk):
+        with self._lock:
+            self._refs[disk] = self._refs.get(disk, 0) + 1
+        try:
+            yield self.mount(disk)
+        finally:
+            with self._lock:
+                self._refs[disk] -= 1
+
+    def unmount(self, disk):
+        with self._disk_lock(disk):
+            with self._lock:
+                if self._refs.get(disk, 0) > 0:
+                    logger.info(f"Backing disk {disk} is in use, keeping it mounted")
+                    return False
+            umount_device(dest=self.path_of(disk))
+            self._mounted.discard(disk)
+            return True
+
+    def prune(self, present_disks):
+        """Unmount backing disks that disappeared from the node."""
+        for disk in list(self._mounted):
+            if disk not in present_disks:
+                logger.info(f"Backing disk {disk} is gone, unmounting it")
+                self.unmount(disk)
+
 
+backing_mounts = BackingMounts()
 
-def expand_img(volume_id, size):
-    img_path = Path(f"{MOUNT_DEST}/{volume_id}/{IMAGE_NAME}")
+
+def expand_img(volume_id, size, root=MOUNT_DEST):
+    img_path = Path(f"{root}/{volume_id}/{IMAGE_NAME}")
     if img_path.exists():
         file_size = os.path.getsize(img_path)
         if size > file_size:
-            run(f"truncate -s {size} {img_path}")
-            return True
+            run(["truncate", "-s", size, img_path])
         else:
-            raise Exception(
-                f"Image size {file_size} is already larger than requested size {size}."
-            )
+            # a retried or concurrent expansion got there first
+            logger.info(f"Image {img_path} is already {file_size} bytes, not growing it to {size}")
+        return True
     else:
         return False
 
 
-def attach_loop(file_path: str) -> str:
-    def get_next_loop_device() -> str:
-        loop_device = run_out(f"losetup -f").stdout.decode().strip()
-        if not Path(loop_device).exists():
-            loop_id = loop_device.replace("/dev/loop", "")
-            run(f"mknod {loop_device} b 7 {loop_id}")
-        return loop_device
+_loop_locks = {}
+_loop_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _file_loop_lock(file_path):
+    with _loop_locks_lock:
+        lock = _loop_locks.setdefault(str(file_path), threading.Lock())
+    with lock:
+        yield
+
+
+# StorageClass parameters applied to /sys/block/loopN/queue, with validators
+QUEUE_PARAMETERS = {
+    "scheduler": lambda v: v in ("none", "mq-deadline", "kyber", "bfq"),
+    "read_ahead_kb": lambda v: v.isdigit(),
+    "nr_requests": lambda v: v.isdigit() and int(v) > 0,
+}
+QUEUE_CONTEXT_PREFIX = "lsdisk.driver/queue."
+
+_LOOP_NODE = re.compile(r"^/loop\d+$")
+
+EXT4_MAGIC = 0xEF53
+XFS_MAGIC = b"XFSB"
+
+
+def queue_context(parameters):
+    """volume_context entries carrying the queue tuning of a StorageClass.
 
-    while True:
+    Raises ValueError for values the kernel would not accept.
+    """
+    context = {}
+    for name, valid in QUEUE_PARAMETERS.items():
+        value = parameters.get(name)
+        if value is None:
+            continue
+        if not valid(value):
+            raise ValueError(f"Invalid value {value!r} for parameter {name}")
+        context[QUEUE_CONTEXT_PREFIX + name] = value
+    return context
+
+
+def queue_settings(volume_context):
+    return {
+        key[len(QUEUE_CONTEXT_PREFIX):]: value
+        for key, value in (volume_context or {}).items()
+        if key.startswith(QUEUE_CONTEXT_PREFIX)
+    }
+
+
+def logical_block_size(disk):
+    with open(f"/sys/block/{disk}/queue/logical_block_size") as f:
+        return int(f.read())
+
+
+def fs_block_size_limit(img_file):
+    """Largest loop block size the filesystem in img_file can be mounted with.
+
+    That is the block size for ext4 and the sector size for XFS, read from
+    the superblock; None if the image holds neither.
+    """
+    with open(img_file, "rb") as f:
+        xfs = f.read(104)
+        f.seek(1024)
+        ext4 = f.read(0x3A)
+    if xfs[:4] == XFS_MAGIC:
+        # sb_sectsize is a big-endian u16 at offset 102
+        return struct.unpack_from(">H", xfs, 102)[0]
+    if len(ext4) == 0x3A and struct.unpack_from("<H", ext4, 0x38)[0] == EXT4_MAGIC:
+        # s_log_block_size at offset 0x18: block size is 1024 << s_log_block_size
+        return 1024 << struct.unpack_from("<I", ext4, 0x18)[0]
+    return None
+
+
+def loop_block_size(disk, img_file):
+    """Loop block size matching the backing disk, so 4Kn disks get direct
+    I/O without read-modify-write, capped by what the image filesystem
+    was made with."""
+    try:
+        size = logical_block_size(disk)
+    except (OSError, ValueError):
+        return 0
+    limit = fs_block_size_limit(img_file)
+    if limit is not None and limit < size:
+        logger.warning(
+            f"Filesystem in {img_file} was made for {limit}-byte blocks, below the {size}-byte blocks of /dev/{disk}"
+        )
+        size = limit
+    return size
+
+
+def _tune_loop(device, queue):
+    if not loop_device.direct_io_enabled(device):
+        logger.warning(f"Direct I/O is off on {device}, I/O goes through the page cache")
+        metrics.inc("loop_direct_io_disabled_total")
+    for name, value in (queue or {}).items():
+        try:
+            loop_device.set_queue_attribute(device, name, value)
+        except OSError as e:
+            logger.warning(f"Cannot set {name}={value} on {device}: {e}")
+            metrics.inc("loop_queue_tuning_failures_total")
+
+
+def attach_loop(file_path: str, block_size=0, queue=None) -> str:
+    with _file_loop_lock(file_path):
         attached_devices = attached_loops_dev(file_path)
         if len(attached_devices) > 0:
             return attached_devices[0]
+        dev = loop_device.attach(file_path, direct_io=True, block_size=block_size)
+        _tune_loop(dev, queue)
+        return dev
 
-        get_next_loop_device()
-        run(f"losetup --direct-io=on -f {file_path}")
+
+@contextmanager
+def attached_loop(file_path: str, block_size=0, queue=None):
+    """Yield a loop device for file_path that goes away with its last user.
+
+    A new device is attached with autoclear, so mounting it inside the
+    block ties its lifetime to the mount; an already attached device is
+    reused as is.
+    """
+    with _file_loop_lock(file_path):
+        attached_devices = attached_loops_dev(file_path)
+        if len(attached_devices) > 0:
+            yield attached_devices[0]
+            return
+        with loop_device.attached(
+            file_path, direct_io=True, block_size=block_size, autoclear=True
+        ) as dev:
+            _tune_loop(dev, queue)
+            yield dev
 
 
 def attached_loops_dev(file: str) -> [str]:
-    out = run_out(f"losetup -j {file}").stdout.decode()
-    lines = out.splitlines()
-    devs = [line.split(":", 1)[0] for line in lines]
-    return devs
+    return loop_index.devices_of(file)
 
 
 def detach_loops(file) -> None:
     devs = attached_loops_dev(file)
     for dev in devs:
-        run(f"losetup -d {dev}")
+        loop_device.detach(dev)
 
 
 def find_loop_from_path(path):
-    res = run_out(
-        f"findmnt --json --first-only --nofsroot --mountpoint {path}"
-    )
-    if res.returncode != 0:
+    entry = mount_table.get(Path(path).resolve())
+    if entry is None:
         return None
-    data = json.loads(res.stdout.decode().strip())
-    return data["filesystems"][0]["source"]
+    # a bind mounted device node (raw block volume) shows up as the
+    # filesystem holding /dev with the node as its root
+    if _LOOP_NODE.match(entry["root"]):
+        return "/dev" + entry["root"]
+    return entry["source"]
 
 
 def path_stats(path):
@@ -248,8 +477,8 @@ def extend_fs(path):
     path = Path(path).resolve()
     fstype = find_fstype(path)
     if fstype == "ext4":
-        run(f"resize2fs {path}")
+        run(["resize2fs", path])
     elif fstype == "xfs":
-        run(f"xfs_growfs -d {path}")
+        run(["xfs_growfs", "-d", path])
     else:
         raise Exception(f"Unsupported fsType: {fstype}")
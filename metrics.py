@@ -0,0 +1,118 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+PREFIX = "lsdisk_"
+# seconds; spans a stat-like lsblk up to a multi-minute mkfs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+
+
+def inc(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def gauges():
+    with _lock:
+        return dict(_gauges)
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            _histograms[key] = histogram
+        for i, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def histograms():
+    with _lock:
+        return {
+            key: dict(histogram, counts=list(histogram["counts"]))
+            for key, histogram in _histograms.items()
+        }
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, value in sorted(snapshot().items()):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.append(f"{PREFIX}{name} {value}")
+    declared = set()
+    for (name, labels), value in sorted(gauges().items()):
+        if name not in declared:
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            declared.add(name)
+        lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms().items()):
+        if name not in declared:
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            declared.add(name)
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            le = labels + (("le", str(bound)),)
+            lines.append(f"{PREFIX}{name}_bucket{_labels(le)} {count}")
+        le = labels + (("le", "+Inf"),)
+        lines.append(f"{PREFIX}{name}_bucket{_labels(le)} {histogram['count']}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {histogram['sum']}")
+        lines.append(f"{PREFIX}{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port):
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on :{port}/metrics")
+    return server
@@ -0,0 +1,176 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import threading
+from utils import run
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_SYNCHRONOUS = 0x10
+MS_DIRSYNC = 0x80
+MS_NOATIME = 0x400
+MS_NODIRATIME = 0x800
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_RELATIME = 0x200000
+MS_STRICTATIME = 0x1000000
+MS_LAZYTIME = 0x2000000
+MNT_DETACH = 0x2
+
+# mount(8) option names of the generic mount flags
+FLAG_OPTIONS = {
+    "ro": MS_RDONLY,
+    "nosuid": MS_NOSUID,
+    "nodev": MS_NODEV,
+    "noexec": MS_NOEXEC,
+    "sync": MS_SYNCHRONOUS,
+    "dirsync": MS_DIRSYNC,
+    "noatime": MS_NOATIME,
+    "nodiratime": MS_NODIRATIME,
+    "relatime": MS_RELATIME,
+    "strictatime": MS_STRICTATIME,
+    "lazytime": MS_LAZYTIME,
+}
+
+_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mount.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_ulong,
+    ctypes.c_char_p,
+]
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+
+def _unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return _ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def normalize(path):
+    return os.path.normpath(os.path.abspath(str(path)))
+
+
+def parse_mountinfo(text):
+    entries = []
+    for line in text.splitlines():
+        fields = line.split()
+        separator = fields.index("-")
+        entries.append(
+            {
+                "id": int(fields[0]),
+                "parent": int(fields[1]),
+                "dev": fields[2],
+                "root": _unescape(fields[3]),
+                "target": _unescape(fields[4]),
+                "options": fields[5],
+                "fstype": fields[separator + 1],
+                "source": _unescape(fields[separator + 2]),
+                "super_options": fields[separator + 3] if len(fields) > separator + 3 else "",
+            }
+        )
+    return entries
+
+
+class MountTable:
+    """Index of /proc/self/mountinfo by exact mount point.
+
+    The file is only re-read when poll() on it reports that the mount
+    table of this namespace changed, so lookups between changes are
+    dictionary hits.
+    """
+
+    def __init__(self, path=MOUNTINFO):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path)
+        self._poller = select.poll()
+        self._poller.register(self._file.fileno(), select.POLLPRI | select.POLLERR)
+        self._by_target = {}
+        self._load()
+
+    def _load(self):
+        self._file.seek(0)
+        by_target = {}
+        for entry in parse_mountinfo(self._file.read()):
+            # the last entry for a mount point is the one on top of the stack
+            by_target[entry["target"]] = entry
+        self._by_target = by_target
+
+    def _refresh(self):
+        with self._lock:
+            if self._poller.poll(0):
+                self._load()
+
+    def get(self, target):
+        self._refresh()
+        return self._by_target.get(normalize(target))
+
+    def is_mounted(self, target):
+        return self.get(target) is not None
+
+    def entries(self):
+        self._refresh()
+        return list(self._by_target.values())
+
+
+mount_table = MountTable()
+
+
+def _syscall_mount(source, target, fstype, flags, data):
+    res = _libc.mount(
+        source.encode() if source else None,
+        target.encode(),
+        fstype.encode() if fstype else None,
+        flags,
+        data.encode() if data else None,
+    )
+    if res != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), target)
+
+
+def mount(source, target, fstype, flags=0, data=""):
+    try:
+        _syscall_mount(str(source), str(target), fstype, flags, data)
+    except OSError as e:
+        logger.warning(f"mount syscall for {target} failed ({e}), using mount(8)")
+        options = [name for name, flag in FLAG_OPTIONS.items() if flags & flag]
+        if data:
+            options.append(data)
+        argv = ["mount", "-t", fstype]
+        if options:
+            argv += ["-o", ",".join(options)]
+        run(argv + [source, target])
+
+
+def bind(source, target, recursive=False):
+    flags = MS_BIND | (MS_REC if recursive else 0)
+    try:
+        _syscall_mount(str(source), str(target), None, flags, None)
+    except OSError as e:
+        logger.warning(f"bind mount syscall for {target} failed ({e}), using mount(8)")
+        run(["mount", "--rbind" if recursive else "--bind", source, target])
+
+
+def umount(target, lazy=False):
+    res = _libc.umount2(str(target).encode(), MNT_DETACH if lazy else 0)
+    if res == 0:
+        return
+    errno = ctypes.get_errno()
+    logger.warning(
+        f"umount syscall for {target} failed ({os.strerror(errno)}), using umount(8)"
+    )
+    run(["umount", "-l", target] if lazy else ["umount", target])
@@ -0,0 +1,132 @@
+import threading
+import time
+from capacity_ledger import (
+    ledger,
+    get_device_with_most_free_space,
+    get_full_free_spaces,
+)
+from logger import get_logger
+from constance.config import LOAD_SAMPLE_INTERVAL
+
+logger = get_logger(__name__)
+
+# index of io_ticks (milliseconds spent doing I/O) in /sys/block/<dev>/stat
+IO_TICKS_FIELD = 9
+
+_lock = threading.Lock()
+_placement_lock = threading.Lock()
+_spread_next = {}
+
+
+def _fitting(disks, size):
+    return [disk for disk in disks if ledger.available(disk) >= size]
+
+
+def most_free(disks, size):
+    """Disk the volume fits on with the most available space (the historical behaviour)."""
+    ledger.ensure(disks)
+    return get_device_with_most_free_space(_fitting(ledger.usable(disks), size))
+
+
+def best_fit(disks, size):
+    """Smallest disk the volume fits on, to keep large holes for large volumes."""
+    ledger.ensure(disks)
+    fitting = _fitting(ledger.usable(disks), size)
+    if not fitting:
+        return ""
+    return min(fitting, key=ledger.available)
+
+
+def spread(disks, size):
+    """Round-robin over the disks the volume fits on."""
+    ledger.ensure(disks)
+    fitting = sorted(_fitting(ledger.usable(disks), size))
+    if not fitting:
+        return ""
+    key = tuple(sorted(disks))
+    with _lock:
+        index = _spread_next.get(key, 0) % len(fitting)
+        _spread_next[key] = index + 1
+    return fitting[index]
+
+
+def _read_io_ticks(disk):
+    with open(f"/sys/block/{disk}/stat") as stat:
+        return int(stat.read().split()[IO_TICKS_FIELD])
+
+
+def disk_utilisation(disks, interval=LOAD_SAMPLE_INTERVAL):
+    """Fraction of time each disk was busy over the next interval seconds."""
+    first = {disk: _read_io_ticks(disk) for disk in disks}
+    start = time.monotonic()
+    time.sleep(interval)
+    elapsed_ms = max((time.monotonic() - start) * 1000, 1)
+    return {disk: (_read_io_ticks(disk) - first[disk]) / elapsed_ms for disk in disks}
+
+
+def _sample_utilisation(disks):
+    try:
+        return disk_utilisation(disks)
+    except OSError as e:
+        logger.warning(f"Cannot read disk utilisation ({e}), falling back to most-free")
+        return {}
+
+
+def least_loaded(disks, size, utilisation=None):
+    """Least busy disk the volume fits on, ties broken by available space.
+
+    utilisation is sampled here unless the caller passes a sample.
+    """
+    ledger.ensure(disks)
+    fitting = _fitting(ledger.usable(disks), size)
+    if not fitting:
+        return ""
+    if utilisation is None:
+        utilisation = _sample_utilisation(fitting)
+    if any(disk not in utilisation for disk in fitting):
+        return most_free(fitting, size)
+    logger.info(f"Disk utilisation: {utilisation}")
+    return min(fitting, key=lambda disk: (utilisation[disk], -ledger.available(disk)))
+
+
+STRATEGIES = {
+    "most-free": most_free,
+    "best-fit": best_fit,
+    "spread": spread,
+    "least-loaded": least_loaded,
+}
+DEFAULT_STRATEGY = "most-free"
+
+
+def select_disk(disks, size, strategy=DEFAULT_STRATEGY):
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown placement strategy {strategy}, expected one of {', '.join(STRATEGIES)}"
+        )
+    return STRATEGIES[strategy](disks, size)
+
+
+def reserve_disk(disks, size, strategy=DEFAULT_STRATEGY, full_disk=False):
+    """Pick a disk and reserve the space of the volume on it in one step.
+
+    Returns (disk, reservation), or ("", None) if no disk fits. The
+    caller commits the reservation once the image exists or releases it
+    if creating the image fails.
+    """
+    ledger.ensure(disks)
+    utilisation = None
+    if strategy == "least-loaded" and not full_disk:
+        # sampling sleeps, so it is done before taking the placement lock
+        utilisation = _sample_utilisation(ledger.usable(disks))
+    with _placement_lock:
+        if full_disk:
+            disk = get_full_free_spaces(disks, size)
+            if disk:
+                size = ledger.get(disk)["free"]
+        elif utilisation is not None:
+            disk = least_loaded(disks, size, utilisation)
+        else:
+            disk = select_disk(disks, size, strategy)
+        if not disk:
+            return "", None
+        return disk, ledger.reserve(disk, size)
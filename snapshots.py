@@ -0,0 +1,225 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from image_copy import reflink, sparse_copy, ReflinkUnsupported
+from loop_device import loop_index, DELETED_SUFFIX
+from mounts import mount_table
+from disk_inventory import get_inventory, disk_identity, find_by_identity
+from utils import be_absent
+from logger import get_logger
+from constance.config import IMAGE_NAME, SNAPSHOT_FREEZE_TIMEOUT
+
+logger = get_logger(__name__)
+
+# snapshots live in {disk}/.snapshots/{name}/ next to the volumes they
+# were taken from, so they can share extents with them
+SNAPSHOT_DIR = ".snapshots"
+META_NAME = "meta.json"
+
+# _IOWR('X', 119, int) and _IOWR('X', 120, int)
+FIFREEZE = 0xC0045877
+FITHAW = 0xC0045878
+
+
+class SnapshotExists(Exception):
+    pass
+
+
+class FreezeTimeout(Exception):
+    pass
+
+
+def snapshot_id(disk, name):
+    inventory_disk = get_inventory()["disks"].get(disk, {"name": disk})
+    return f"{disk_identity(inventory_disk)}/{name}"
+
+
+def parse_snapshot_id(snap_id):
+    """(disk, name) of a snapshot id, disk None if it is not on this node."""
+    if "/" not in snap_id:
+        return None, None
+    identity, name = snap_id.rsplit("/", 1)
+    return find_by_identity(get_inventory(), identity), name
+
+
+def _snapshot_path(path, name):
+    return f"{path}/{SNAPSHOT_DIR}/{name}"
+
+
+def read_snapshot(disk, path, name):
+    """Snapshot record of name on the disk mounted at path, None if absent."""
+    snap_dir = _snapshot_path(path, name)
+    try:
+        with open(f"{snap_dir}/{META_NAME}") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not os.path.isfile(f"{snap_dir}/{IMAGE_NAME}"):
+        # an interrupted CreateSnapshot, redone on retry
+        return None
+    return dict(meta, snapshot_id=snapshot_id(disk, name), image=f"{snap_dir}/{IMAGE_NAME}")
+
+
+def list_snapshots(disk, path):
+    try:
+        names = os.listdir(f"{path}/{SNAPSHOT_DIR}")
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for name in sorted(names):
+        snapshot = read_snapshot(disk, path, name)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def _mountpoint_of(img_file):
+    for device in loop_index.devices_of(img_file):
+        for entry in mount_table.entries():
+            if entry["source"] == device:
+                return entry["target"]
+    return None
+
+
+@contextmanager
+def frozen(img_file, timeout=None):
+    """Freeze the filesystem of the volume in img_file if it is mounted here.
+
+    Writes are blocked and the filesystem is flushed to the image until
+    the block exits, so a clone taken inside it is consistent. With
+    timeout a watchdog thaws the filesystem after that many seconds and
+    sets the yielded event; the block then fails with FreezeTimeout
+    because what it cloned is no longer consistent.
+    """
+    expired = threading.Event()
+    mountpoint = _mountpoint_of(img_file)
+    if mountpoint is None:
+        yield expired
+        return
+    fd = os.open(mountpoint, os.O_RDONLY)
+    try:
+        try:
+            fcntl.ioctl(fd, FIFREEZE, 0)
+        except OSError as e:
+            # EBUSY: someone else froze it already, which is just as good
+            logger.warning(f"Cannot freeze {mountpoint}: {e}")
+            yield expired
+            return
+        lock = threading.Lock()
+        state = {"frozen": True}
+
+        def thaw():
+            with lock:
+                if state["frozen"]:
+                    state["frozen"] = False
+                    fcntl.ioctl(fd, FITHAW, 0)
+
+        def expire():
+            logger.warning(f"{mountpoint} was frozen for {timeout}s, thawing it")
+            expired.set()
+            thaw()
+
+        watchdog = None
+        if timeout:
+            watchdog = threading.Timer(timeout, expire)
+            watchdog.daemon = True
+            watchdog.start()
+        message = f"{mountpoint} cannot stay frozen for more than {timeout}s"
+        try:
+            yield expired
+        except Exception as e:
+            if expired.is_set():
+                raise FreezeTimeout(message) from e
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            thaw()
+        if expired.is_set():
+            raise FreezeTimeout(message)
+    finally:
+        os.close(fd)
+
+
+def thaw_volumes():
+    """Thaw the mounted volumes a killed plugin may have left frozen.
+
+    A frozen filesystem is not thawed when the process holding it goes
+    away, so this runs at startup, when no snapshot can be in progress.
+    """
+    for device, path in loop_index.attached().items():
+        if os.path.basename(path.removesuffix(DELETED_SUFFIX)) != IMAGE_NAME:
+            continue
+        for entry in mount_table.entries():
+            if entry["source"] != device:
+                continue
+            try:
+                fd = os.open(entry["target"], os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.ioctl(fd, FITHAW, 0)
+                logger.warning(f"Thawed {entry['target']}, left frozen by a previous run")
+            except OSError:
+                # EINVAL: it was not frozen
+                pass
+            finally:
+                os.close(fd)
+
+
+def create_snapshot(disk, path, name, volume, allow_copy=False):
+    """Clone the image of volume into snapshot name and return its record.
+
+    Raises ReflinkUnsupported if the backing filesystem cannot reflink
+    and allow_copy is not set, FreezeTimeout if the copy does not finish
+    within SNAPSHOT_FREEZE_TIMEOUT and SnapshotExists if name is already
+    a snapshot of another volume.
+    """
+    existing = read_snapshot(disk, path, name)
+    if existing is not None:
+        if existing["source_volume_id"] != volume:
+            raise SnapshotExists(
+                f"Snapshot {name} already exists for volume {existing['source_volume_id']}"
+            )
+        return existing
+    snap_dir = _snapshot_path(path, name)
+    be_absent(snap_dir)
+    os.makedirs(snap_dir)
+    img_file = f"{path}/{volume}/{IMAGE_NAME}"
+    tmp_file = f"{snap_dir}/.{IMAGE_NAME}.tmp"
+    start = time.monotonic()
+    try:
+        try:
+            with frozen(img_file):
+                reflink(img_file, tmp_file)
+            method = "reflink"
+        except ReflinkUnsupported:
+            if not allow_copy:
+                raise
+            # writes stall for as long as the copy runs, so the freeze is
+            # bounded and the copy stops when the watchdog thaws
+            with frozen(img_file, timeout=SNAPSHOT_FREEZE_TIMEOUT) as expired:
+                sparse_copy(img_file, tmp_file, stop=expired)
+            method = "copy"
+        meta = {
+            "source_volume_id": volume,
+            "creation_time": time.time(),
+            "size": os.path.getsize(tmp_file),
+        }
+        with open(f"{snap_dir}/{META_NAME}", "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp_file, f"{snap_dir}/{IMAGE_NAME}")
+    except Exception:
+        be_absent(snap_dir)
+        raise
+    logger.info(
+        f"Snapshot {name} of {volume} taken by {method} in {time.monotonic() - start:.3f}s"
+    )
+    return read_snapshot(disk, path, name)
+
+
+def delete_snapshot(path, name):
+    return be_absent(_snapshot_path(path, name))
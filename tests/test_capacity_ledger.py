@@ -0,0 +1,164 @@
+import threading
+import capacity_ledger
+from capacity_ledger import CapacityLedger
+
+GiB = 1024 * 1024 * 1024
+
+
+def _entry(free, volumes=None):
+    volumes = dict(volumes or {})
+    return {
+        "total": 100 * GiB,
+        "used": 100 * GiB - free,
+        "free": free,
+        "committed": sum(size for size, _ in volumes.values()),
+        "allocated": sum(blocks for _, blocks in volumes.values()),
+        "volumes": volumes,
+    }
+
+
+def test_probe_does_not_stack_stuck_probes(monkeypatch):
+    monkeypatch.setattr(capacity_ledger, "PROBE_TIMEOUT", 0.05)
+    monkeypatch.setattr(capacity_ledger, "PROBE_BACKOFF", 0)
+    ledger = CapacityLedger()
+    release = threading.Event()
+    calls = []
+
+    def hung_scan(disk):
+        calls.append(disk)
+        release.wait(5)
+        return _entry(10 * GiB)
+
+    monkeypatch.setattr(ledger, "_scan", hung_scan)
+    for _ in range(3):
+        ledger.probe(["sda"])
+    assert calls == ["sda"]
+    assert ledger.available("sda") == 0
+    release.set()
+    ledger._probes["sda"].result(5)
+    assert ledger.available("sda") == 10 * GiB
+    # once finished, the disk is probed again
+    ledger.probe(["sda"])
+    assert calls == ["sda", "sda"]
+
+
+class _FsUsage:
+    def __init__(self, free):
+        self.total = 100 * GiB
+        self.used = 100 * GiB - free
+        self.free = free
+
+
+def _loaded_ledger(monkeypatch, free=10 * GiB, volumes=None):
+    ledger = CapacityLedger()
+    monkeypatch.setattr(ledger, "_scan", lambda disk: _entry(free, volumes))
+    ledger.load("sda")
+    return ledger
+
+
+def test_reserve_and_release(monkeypatch):
+    ledger = _loaded_ledger(monkeypatch)
+    reservation = ledger.reserve("sda", 4 * GiB)
+    assert ledger.available("sda") == 6 * GiB
+    assert ledger.reserved("sda") == 4 * GiB
+    assert ledger.release(reservation) == "sda"
+    assert ledger.available("sda") == 10 * GiB
+    # releasing twice is harmless
+    assert ledger.release(reservation) is None
+    assert ledger.available("sda") == 10 * GiB
+
+
+def test_commit_never_frees_the_reserved_space(monkeypatch):
+    ledger = _loaded_ledger(monkeypatch)
+    reservation = ledger.reserve("sda", 4 * GiB)
+    seen = []
+
+    def measure(disk, volume, present=True):
+        # a concurrent reserve() runs while the image is being measured
+        seen.append(ledger.available(disk))
+        return (4 * GiB, GiB), _FsUsage(9 * GiB)
+
+    monkeypatch.setattr(ledger, "_measure", measure)
+    ledger.commit(reservation, "pvc-1")
+    assert seen == [6 * GiB]
+    assert ledger.reserved("sda") == 0
+    assert ledger.locate("pvc-1") == "sda"
+    # 9GiB free minus the 3GiB the sparse image may still grow into
+    assert ledger.available("sda") == 6 * GiB
+
+
+def test_load_keeps_volumes_committed_during_the_scan(monkeypatch):
+    ledger = _loaded_ledger(monkeypatch)
+    reservation = ledger.reserve("sda", 4 * GiB)
+    monkeypatch.setattr(
+        ledger, "_measure", lambda disk, volume, present=True: ((4 * GiB, GiB), _FsUsage(9 * GiB))
+    )
+
+    def scan(disk):
+        # the scan listed the disk before pvc-1 existed
+        entry = _entry(10 * GiB)
+        ledger.commit(reservation, "pvc-1")
+        return entry
+
+    monkeypatch.setattr(ledger, "_scan", scan)
+    ledger.load("sda")
+    assert ledger.locate("pvc-1") == "sda"
+    assert ledger.get("sda")["volumes"] == {"pvc-1": (4 * GiB, GiB)}
+    assert ledger.available("sda") == 6 * GiB
+
+
+def test_load_drops_volumes_removed_during_the_scan(monkeypatch):
+    ledger = _loaded_ledger(monkeypatch, volumes={"pvc-1": (4 * GiB, GiB)})
+    monkeypatch.setattr(
+        ledger, "_measure", lambda disk, volume, present=True: (None, _FsUsage(10 * GiB))
+    )
+
+    def scan(disk):
+        entry = _entry(9 * GiB, {"pvc-1": (4 * GiB, GiB)})
+        ledger.remove_volume("pvc-1")
+        return entry
+
+    monkeypatch.setattr(ledger, "_scan", scan)
+    ledger.load("sda")
+    assert ledger.locate("pvc-1") is None
+    assert ledger.get("sda")["committed"] == 0
+
+
+def test_available_counts_what_sparse_images_may_still_use(monkeypatch):
+    # 10GiB free, one 8GiB image with 2GiB written
+    ledger = _loaded_ledger(monkeypatch, volumes={"pvc-1": (8 * GiB, 2 * GiB)})
+    assert ledger.available("sda") == 4 * GiB
+    assert ledger.locate("pvc-1") == "sda"
+    assert ledger.available("unknown") == 0
+
+
+def test_add_and_remove_volume(monkeypatch):
+    ledger = _loaded_ledger(monkeypatch)
+    monkeypatch.setattr(
+        ledger, "_measure", lambda disk, volume, present=True: ((4 * GiB, 0), _FsUsage(10 * GiB))
+    )
+    ledger.add_volume("sda", "pvc-1")
+    assert ledger.available("sda") == 6 * GiB
+    assert ledger.locate("pvc-1") == "sda"
+    monkeypatch.setattr(
+        ledger, "_measure", lambda disk, volume, present=True: (None, _FsUsage(10 * GiB))
+    )
+    ledger.remove_volume("pvc-1")
+    assert ledger.available("sda") == 10 * GiB
+    assert ledger.locate("pvc-1") is None
+
+
+def test_capacity_helpers(monkeypatch):
+    ledger = CapacityLedger()
+    entries = {
+        "sda": dict(_entry(10 * GiB), total=10 * GiB, used=0),
+        "sdb": _entry(20 * GiB, {"pvc-1": (GiB, GiB)}),
+    }
+    monkeypatch.setattr(ledger, "_scan", lambda disk: dict(entries[disk]))
+    monkeypatch.setattr(capacity_ledger, "ledger", ledger)
+    assert capacity_ledger.get_available_capacity(["sda", "sdb"]) == 20 * GiB
+    assert capacity_ledger.get_device_with_most_free_space(["sda", "sdb"]) == "sdb"
+    # full disk volumes only go to disks without volumes or reservations
+    assert capacity_ledger.get_full_free_spaces(["sda", "sdb"], 5 * GiB) == "sda"
+    ledger.reserve("sda", GiB)
+    assert capacity_ledger.get_full_free_spaces(["sda", "sdb"], 5 * GiB) == ""
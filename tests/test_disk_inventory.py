@@ -0,0 +1,29 @@
+import json
+import subprocess
+import disk_inventory
+
+
+def _lsblk(monkeypatch, devices):
+    output = json.dumps({"blockdevices": devices}).encode()
+
+    def run_out(cmd):
+        if cmd[0] == "lsblk":
+            return subprocess.CompletedProcess(cmd, 0, output, b"")
+        return subprocess.CompletedProcess(cmd, 1, b"", b"")
+
+    monkeypatch.setattr(disk_inventory, "run_out", run_out)
+
+
+def test_scan_lsblk_skips_non_disks(monkeypatch):
+    _lsblk(
+        monkeypatch,
+        [
+            {"name": "sda", "model": "EG002400JXLWC ", "rota": "1", "type": "disk"},
+            {"name": "sr0", "model": "DVD-ROM", "rota": "1", "type": "rom"},
+            {"name": "loop0", "model": None, "rota": "0", "type": "loop"},
+        ],
+    )
+    disks = disk_inventory._scan_lsblk()
+    assert [disk["name"] for disk in disks] == ["sda"]
+    assert disks[0]["model"] == "EG002400JXLWC"
+    assert disks[0]["rotational"]
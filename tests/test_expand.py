@@ -0,0 +1,30 @@
+import os
+import lsdisk_utils
+from lsdisk_utils import expand_img
+
+
+def _image(tmp_path, size, monkeypatch):
+    monkeypatch.setattr(lsdisk_utils, "IMAGE_NAME", "disk.img")
+    (tmp_path / "pvc-1").mkdir()
+    img = tmp_path / "pvc-1" / "disk.img"
+    img.write_bytes(b"")
+    os.truncate(img, size)
+    return img
+
+
+def test_expand_img(tmp_path, monkeypatch):
+    img = _image(tmp_path, 1024, monkeypatch)
+    assert expand_img("pvc-1", 4096, root=tmp_path)
+    assert os.path.getsize(img) == 4096
+
+
+def test_expand_img_already_large_enough(tmp_path, monkeypatch):
+    img = _image(tmp_path, 4096, monkeypatch)
+    assert expand_img("pvc-1", 4096, root=tmp_path)
+    assert expand_img("pvc-1", 2048, root=tmp_path)
+    assert os.path.getsize(img) == 4096
+
+
+def test_expand_img_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(lsdisk_utils, "IMAGE_NAME", "disk.img")
+    assert not expand_img("pvc-1", 4096, root=tmp_path)
@@ -0,0 +1,114 @@
+import pytest
+import mounts
+from filesystems import (
+    EXT4,
+    XFS,
+    MKFS_DEFAULTS,
+    check_fstype,
+    mkfs_argv,
+    parse_mkfs_options,
+    parse_mount_options,
+)
+
+
+def test_check_fstype():
+    assert check_fstype(XFS) == XFS
+    with pytest.raises(ValueError):
+        check_fstype("btrfs")
+
+
+def test_parse_mkfs_options():
+    assert parse_mkfs_options(EXT4, "-m 0 -E stride=16,stripe_width=64") == [
+        "-m",
+        "0",
+        "-E",
+        "stride=16,stripe_width=64",
+    ]
+    assert parse_mkfs_options(XFS, "-K -l su=64k") == ["-K", "-l", "su=64k"]
+    assert parse_mkfs_options(EXT4, "") == []
+    assert parse_mkfs_options(EXT4, None) == []
+
+
+@pytest.mark.parametrize(
+    "fstype, options",
+    [
+        # not on the allow-list
+        (EXT4, "-F"),
+        (EXT4, "-K"),
+        (XFS, "-f"),
+        # set by the defaults, mkfs.xfs refuses it twice
+        (XFS, "-s size=512"),
+        # missing values
+        (EXT4, "-m"),
+        (EXT4, "-m -E stride=16"),
+        # pointing mkfs at other files
+        (XFS, "-d file=/etc/passwd"),
+        (XFS, "-l logdev=/dev/sda,name=/dev/sdb"),
+        (XFS, "-p protofile"),
+        (XFS, "-l logdev=/dev/sdb,size=64m"),
+        (XFS, "-l logdev=sdb"),
+        (XFS, "-r rtdev=/dev/sdb"),
+        (XFS, "-d su=64k -l internal=0,agcount=/dev/sdb"),
+        (EXT4, "-E device=/dev/sda"),
+    ],
+)
+def test_parse_mkfs_options_rejects(fstype, options):
+    with pytest.raises(ValueError):
+        parse_mkfs_options(fstype, options)
+
+
+def test_mkfs_argv_defaults():
+    assert mkfs_argv(EXT4, [], "img") == ["mkfs.ext4", *MKFS_DEFAULTS[EXT4], "img"]
+    assert mkfs_argv(XFS, ["-K"], "img") == ["mkfs.xfs", *MKFS_DEFAULTS[XFS], "-K", "img"]
+
+
+def test_mkfs_argv_merges_every_extended_option():
+    options = parse_mkfs_options(EXT4, "-E stride=16 -m 0 -E stripe_width=64")
+    argv = mkfs_argv(EXT4, options, "img")
+    assert argv.count("-E") == 1
+    extended = argv[argv.index("-E") + 1].split(",")
+    assert extended == [
+        "lazy_itable_init=1",
+        "lazy_journal_init=1",
+        "nodiscard",
+        "stride=16",
+        "stripe_width=64",
+    ]
+    assert argv[-3:] == ["-m", "0", "img"]
+
+
+def test_mkfs_argv_does_not_change_defaults():
+    mkfs_argv(EXT4, ["-E", "stride=16"], "img")
+    assert "stride=16" not in MKFS_DEFAULTS[EXT4][3]
+
+
+def test_parse_mount_options():
+    flags, data = parse_mount_options(
+        EXT4, ["noatime,lazytime, data=writeback", "defaults", "", "nodiscard"]
+    )
+    assert flags == mounts.MS_NOATIME | mounts.MS_LAZYTIME
+    assert data == "data=writeback,nodiscard"
+    assert parse_mount_options(XFS, ["logbsize=256k,inode64,ro"]) == (
+        mounts.MS_RDONLY,
+        "logbsize=256k,inode64",
+    )
+    assert parse_mount_options(EXT4, []) == (0, "")
+
+
+@pytest.mark.parametrize(
+    "fstype, option",
+    [
+        # other filesystem's options
+        (EXT4, "logbsize=256k"),
+        (XFS, "data=writeback"),
+        # a value for an option without one and the other way round
+        (EXT4, "nobarrier=1"),
+        (EXT4, "data"),
+        # not allowed at all
+        (EXT4, "bind"),
+        (XFS, "context=system_u:object_r:tmp_t"),
+    ],
+)
+def test_parse_mount_options_rejects(fstype, option):
+    with pytest.raises(ValueError):
+        parse_mount_options(fstype, [option])
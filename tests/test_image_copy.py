@@ -0,0 +1,45 @@
+import os
+import threading
+import pytest
+from image_copy import sparse_copy
+
+MiB = 1024 * 1024
+
+
+def _sparse_file(path):
+    with open(path, "wb") as f:
+        f.truncate(16 * MiB)
+        f.seek(MiB)
+        f.write(b"a" * 4096)
+        f.seek(12 * MiB)
+        f.write(b"b" * MiB)
+
+
+def test_sparse_copy(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _sparse_file(src)
+    copied = sparse_copy(src, dst)
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.path.getsize(dst) == 16 * MiB
+    # only the data regions are copied, the holes stay holes
+    assert copied < 16 * MiB
+    assert os.stat(dst).st_blocks * 512 < 16 * MiB
+
+
+def test_sparse_copy_refuses_existing_dst(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _sparse_file(src)
+    dst.write_bytes(b"keep")
+    with pytest.raises(FileExistsError):
+        sparse_copy(src, dst)
+    assert dst.read_bytes() == b"keep"
+
+
+def test_sparse_copy_stop(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _sparse_file(src)
+    stop = threading.Event()
+    stop.set()
+    with pytest.raises(InterruptedError):
+        sparse_copy(src, dst, stop=stop)
+    assert not dst.exists()
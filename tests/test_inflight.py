@@ -0,0 +1,52 @@
+import threading
+import pytest
+from utils import InFlight
+
+
+def test_joins_running_operation():
+    operations = InFlight(4, "test")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "done"
+
+    with pytest.raises(TimeoutError):
+        operations.do("pvc-1", work, timeout=0.05)
+    assert started.wait(5)
+    # the retry joins the operation that is still running
+    joined = threading.Thread(target=lambda: calls.append(operations.do("pvc-1", work)))
+    joined.start()
+    release.set()
+    joined.join(5)
+    assert calls == [1, "done"]
+
+
+def test_runs_again_once_finished():
+    operations = InFlight(2, "test")
+    assert operations.do("pvc-1", lambda: 1) == 1
+    assert operations.do("pvc-1", lambda: 2) == 2
+
+
+def test_different_keys_run_separately():
+    operations = InFlight(2, "test")
+    release = threading.Event()
+    with pytest.raises(TimeoutError):
+        operations.do("pvc-1", lambda: release.wait(5), timeout=0.05)
+    assert operations.do("pvc-2", lambda: "other", timeout=5) == "other"
+    release.set()
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    operations = InFlight(2, "test")
+
+    def fail():
+        raise OSError("mkfs failed")
+
+    with pytest.raises(OSError):
+        operations.do("pvc-1", fail)
+    assert operations.do("pvc-1", lambda: "retried") == "retried"
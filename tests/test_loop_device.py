@@ -0,0 +1,14 @@
+import os
+from loop_device import LOOP_CONFIG, LOOP_INFO64, _decode_dev
+
+
+def test_struct_sizes():
+    # sizeof(struct loop_info64) and sizeof(struct loop_config)
+    assert LOOP_INFO64.size == 232
+    assert LOOP_CONFIG.size == 304
+
+
+def test_decode_dev():
+    # new_encode_dev(): minor low byte, major, then the rest of the minor
+    assert _decode_dev((7 << 8) | 3) == os.makedev(7, 3)
+    assert _decode_dev((259 << 8) | 0x12 | (0x3 << 20)) == os.makedev(259, 0x312)
@@ -0,0 +1,22 @@
+from mounts import parse_mountinfo
+
+MOUNTINFO = (
+    "22 1 259:2 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p2 rw\n"
+    "530 22 7:3 / /var/lib/kubelet/plugins/kubernetes.io/csi/lsdisk.driver/abc/globalmount"
+    " rw,noatime shared:300 master:2 - xfs /dev/loop3 rw,attr2,inode64\n"
+    "531 22 0:5 /loop3 /var/lib/kubelet/pods/p/volumeDevices/my\\040volume rw - devtmpfs udev rw\n"
+    "40 22 0:40 / /mnt/disk rw - tmpfs tmpfs\n"
+)
+
+
+def test_parse_mountinfo():
+    root, staged, device, tmpfs = parse_mountinfo(MOUNTINFO)
+    assert root["id"] == 22 and root["parent"] == 1
+    assert root["target"] == "/" and root["source"] == "/dev/nvme0n1p2"
+    assert staged["dev"] == "7:3"
+    assert staged["fstype"] == "xfs"
+    assert staged["options"] == "rw,noatime"
+    assert staged["super_options"] == "rw,attr2,inode64"
+    assert device["root"] == "/loop3"
+    assert device["target"] == "/var/lib/kubelet/pods/p/volumeDevices/my volume"
+    assert tmpfs["super_options"] == ""
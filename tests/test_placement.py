@@ -0,0 +1,87 @@
+import pytest
+import capacity_ledger
+import placement
+from capacity_ledger import CapacityLedger
+
+GiB = 1024 * 1024 * 1024
+
+FREE = {"sda": 10 * GiB, "sdb": 30 * GiB, "sdc": 20 * GiB}
+
+
+@pytest.fixture(autouse=True)
+def ledger(monkeypatch):
+    ledger = CapacityLedger()
+
+    def scan(disk):
+        return {
+            "total": 100 * GiB,
+            "used": 100 * GiB - FREE[disk],
+            "free": FREE[disk],
+            "committed": 0,
+            "allocated": 0,
+            "volumes": {},
+        }
+
+    monkeypatch.setattr(ledger, "_scan", scan)
+    monkeypatch.setattr(capacity_ledger, "ledger", ledger)
+    monkeypatch.setattr(placement, "ledger", ledger)
+    monkeypatch.setattr(placement, "_spread_next", {})
+    return ledger
+
+
+def test_most_free():
+    assert placement.select_disk(list(FREE), GiB, "most-free") == "sdb"
+    assert placement.select_disk(list(FREE), 40 * GiB, "most-free") == ""
+
+
+def test_best_fit():
+    assert placement.select_disk(list(FREE), GiB, "best-fit") == "sda"
+    assert placement.select_disk(list(FREE), 15 * GiB, "best-fit") == "sdc"
+
+
+def test_spread():
+    picks = [placement.select_disk(list(FREE), GiB, "spread") for _ in range(4)]
+    assert picks == ["sda", "sdb", "sdc", "sda"]
+    # disks the volume does not fit on are skipped
+    assert placement.select_disk(list(FREE), 25 * GiB, "spread") == "sdb"
+
+
+def test_least_loaded(monkeypatch):
+    ticks = {"sda": [0, 150], "sdb": [0, 100], "sdc": [0, 10]}
+    monkeypatch.setattr(placement, "_read_io_ticks", lambda disk: ticks[disk].pop(0))
+    assert placement.select_disk(list(FREE), GiB, "least-loaded") == "sdc"
+
+
+def test_least_loaded_falls_back_to_most_free(monkeypatch):
+    def unreadable(disk):
+        raise FileNotFoundError(disk)
+
+    monkeypatch.setattr(placement, "_read_io_ticks", unreadable)
+    assert placement.select_disk(list(FREE), GiB, "least-loaded") == "sdb"
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        placement.select_disk(list(FREE), GiB, "random")
+
+
+def test_reserve_disk(ledger):
+    disk, reservation = placement.reserve_disk(list(FREE), 25 * GiB)
+    assert disk == "sdb" and ledger.reserved("sdb") == 25 * GiB
+    # the reservation counts against the next placement
+    assert placement.reserve_disk(list(FREE), 25 * GiB) == ("", None)
+    ledger.release(reservation)
+    assert placement.reserve_disk(["sda"], 100 * GiB) == ("", None)
+
+
+def test_reserve_disk_samples_load_without_the_lock(monkeypatch):
+    held = []
+
+    def ticks(disk):
+        held.append(placement._placement_lock.locked())
+        return 0
+
+    monkeypatch.setattr(placement, "_read_io_ticks", ticks)
+    disk, _ = placement.reserve_disk(list(FREE), GiB, "least-loaded")
+    assert disk == "sdb"
+    assert held and not any(held)
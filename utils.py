@@ -1,153 +1,127 @@
 from asyncio import sleep
-import time
 import os
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 import shutil
+from typing import NamedTuple
 
-from munch import Munch
-from kubernetes import client, config
+import metrics
 from logger import get_logger
+from constance.config import COMMAND_TIMEOUT
 
 logger = get_logger(__name__)
-config.load_incluster_config()
 
+_rpc = threading.local()
 
-def run(cmd):
-    return subprocess.run(cmd, shell=True, check=True)
 
+class CommandResult(NamedTuple):
+    argv: list
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    duration: float
 
-def run_out(cmd: str):
-    p = subprocess.run(cmd, shell=True, capture_output=True)
-    return p
 
-
-def get_node_name():
-    return os.getenv("NODE_NAME")
+@contextmanager
+def rpc_deadline(time_remaining):
+    """Bound the commands run by this thread by the current RPC's deadline."""
+    previous = getattr(_rpc, "deadline", None)
+    if time_remaining is None:
+        _rpc.deadline = None
+    else:
+        _rpc.deadline = time.monotonic() + time_remaining
+    try:
+        yield
+    finally:
+        _rpc.deadline = previous
+
+
+def command_timeout(timeout=None):
+    timeout = COMMAND_TIMEOUT if timeout is None else timeout
+    deadline = getattr(_rpc, "deadline", None)
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.monotonic())
+    return timeout
+
+
+class InFlight:
+    """Operations running in the background, keyed by name.
+
+    do() starts func unless an operation with the same key is running
+    already, and waits for the result up to timeout either way. A caller
+    that times out leaves the operation running, so its retry joins it
+    instead of doing the work again. Operations do not run under the
+    deadline of the RPC that started them; their commands get the full
+    COMMAND_TIMEOUT.
+    """
+
+    def __init__(self, max_workers, name):
+        self._lock = threading.Lock()
+        self._running = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            future = self._running.get(key)
+            # a finished operation can still be listed until its callback runs
+            started = future is None or future.done()
+            if started:
+                future = self._executor.submit(func)
+                self._running[key] = future
+        if started:
+            future.add_done_callback(lambda f: self._finished(key, f))
+        else:
+            logger.info(f"Joining operation {key} that is already running")
+            metrics.inc("inflight_joins_total")
+        return future.result(timeout)
+
+
+def _execute(argv, timeout):
+    argv = [str(arg) for arg in argv]
+    name = os.path.basename(argv[0])
+    timeout = command_timeout(timeout)
+    if timeout <= 0:
+        raise subprocess.TimeoutExpired(argv, 0)
+    start = time.monotonic()
+    try:
+        p = subprocess.run(argv, capture_output=True, timeout=timeout)
+    finally:
+        duration = time.monotonic() - start
+        metrics.observe("command_duration_seconds", duration, command=name)
+    return CommandResult(argv, p.returncode, p.stdout, p.stderr, duration)
 
 
-def get_node_from_pv(pvname):
-    v1 = client.CoreV1Api()
-    pv = v1.read_persistent_volume(pvname)
-    pv = Munch.fromDict(pv)
-    node_name = (
-        pv.spec.node_affinity.required.node_selector_terms[0]
-        .match_expressions[0]
-        .values[0]
-    )
-    if node_name == "":
-        raise Exception("Node name is empty")
-    return node_name
-
-
-def get_storageclass_storagemodel_param(storageclass_name):
-    api_instance = client.StorageV1Api()
-    storage_class = api_instance.read_storage_class(storageclass_name)
-    storage_class = Munch.fromDict(storage_class)
-    storage_model = storage_class.parameters["storagemodel"]
-    return str(storage_model)
-
-def get_storageclass_disktype_param(storageclass_name):
-    api_instance = client.StorageV1Api()
-    storage_class = api_instance.read_storage_class(storageclass_name)
-    storage_class = Munch.fromDict(storage_class)
-    storage_model = storage_class.parameters["disk_type"]
-    return storage_model
-
-def get_storageclass_fulldisk_param(storageclass_name):
-    api_instance = client.StorageV1Api()
-    storage_class = api_instance.read_storage_class(storageclass_name)
-    storage_class = Munch.fromDict(storage_class)
-    storage_model = storage_class.parameters["full_disk"]
-    return storage_model
-
-def get_storageclass_from_pv(pvname):
-    api_instance = client.CoreV1Api()
-    pv = api_instance.read_persistent_volume(pvname)
-    pv = Munch.fromDict(pv)
-    return pv.spec.storage_class_name
-
-
-def run_pod(
-    pod_name, node, image, namespace="default", command=None, args=None, env_vars=None
-):
-    v1 = client.CoreV1Api()
-
-    env = []
-    if env_vars:
-        env = [client.V1EnvVar(name=k, value=str(v)) for k, v in env_vars.items()]
-
-    container = client.V1Container(
-        name=pod_name,
-        image=image,
-        command=command,
-        args=args,
-        env=env,
-        security_context=client.V1SecurityContext(
-            privileged=True
-        ),  # Add securityContext here
-    )
-
-    # Add nodeSelector to specify the node
-    pod_spec = client.V1PodSpec(
-        containers=[container],
-        restart_policy="Never",
-        node_selector={"kubernetes.io/hostname": node},  # Specify the node here
-        tolerations=[client.V1Toleration(operator="Exists")],  # tolerate all taints
-    )
-
-    metadata = client.V1ObjectMeta(name=pod_name)
-
-    pod = client.V1Pod(
-        api_version="v1",
-        kind="Pod",
-        metadata=metadata,
-        spec=pod_spec,
-    )
+def run(argv, timeout=None):
+    """Run argv without a shell; raise CalledProcessError if it fails."""
+    result = _execute(argv, timeout)
+    if result.returncode != 0:
+        logger.error(
+            f"{' '.join(result.argv)} failed with exit code {result.returncode}: {result.stderr.decode().strip()}"
+        )
+        raise subprocess.CalledProcessError(
+            result.returncode, result.argv, result.stdout, result.stderr
+        )
+    return result
 
-    try:
-        response = v1.create_namespaced_pod(namespace=namespace, body=pod)
-        logger.info(f"Pod {pod_name} created in namespace {namespace}")
-        return response
-    except client.exceptions.ApiException as e:
-        # If pod already exists, return the existing pod instead of raising
-        if getattr(e, "status", None) == 409:
-            logger.info(f"Pod {pod_name} already exists in namespace {namespace}, returning existing pod")
-            try:
-                existing = v1.read_namespaced_pod(name=pod_name, namespace=namespace)
-                return existing
-            except client.exceptions.ApiException as read_e:
-                logger.error(f"Failed to read existing pod {pod_name}: {read_e}")
-                raise
-        logger.error(f"Exception when creating pod: {e}")
-        raise
-
-
-def cleanup_pod(pod_name, namespace="default"):
-
-    v1 = client.CoreV1Api()
-    try:
-        while True:
-            pod_status = v1.read_namespaced_pod_status(
-                name=pod_name, namespace=namespace
-            )
-            phase = pod_status.status.phase
-            logger.info(f"Pod {pod_name} is in phase: {phase}")
 
-            if phase in ["Succeeded", "Failed"]:
-                logger.info(f"Pod {pod_name} has finished with phase: {phase}")
-                break
+def run_out(argv, timeout=None):
+    """Run argv without a shell and return its result whatever the exit code."""
+    return _execute(argv, timeout)
 
-            time.sleep(2)
 
-        v1.delete_namespaced_pod(name=pod_name, namespace=namespace)
-        return True
-    except client.exceptions.ApiException as e:
-        if getattr(e, "status", None) == 404:
-            logger.info(f"Pod {pod_name} not found in namespace {namespace}, nothing to clean up")
-            return True
-        logger.error(f"Exception when monitoring or deleting pod: {e}")
-        raise
+def get_node_name():
+    return os.getenv("NODE_NAME")
 
 
 def be_absent(path):